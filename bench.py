@@ -0,0 +1,279 @@
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_golden.json')
+GOLDEN_COUNT = 100
+FIRST_THREAD_ID = 1000
+# Wall time a fresh interpreter may spend on "import pageparse"; every pool worker and CLI call pays it.
+IMPORT_BUDGET_MS = 200
+# Packages a parse-only import must leave for the code that uses them.
+DEFERRED_MODULES = ('sqlalchemy', 'bs4', 'tqdm', 'numpy', 'pyarrow')
+IMPORT_PROBE = """
+import sys, time
+started = time.perf_counter()
+import {module}
+print((time.perf_counter() - started) * 1000)
+print(' '.join(name for name in {deferred!r} if name in sys.modules))
+"""
+
+TAGS = ['2dcg', '3dcg', 'bdsm', 'ntr', 'pov', 'rpg', 'anal sex', 'big tits', 'male protagonist', 'female protagonist',
+        'sandbox', 'vaginal sex', 'romance', 'animated', 'corruption', 'harem', 'incest', 'milf', 'school setting',
+        'voyeurism', 'teasing', 'humor', 'fantasy', 'sci-fi', 'dating sim']
+HEADINGS = ['<b>Overview:</b>', 'Overview:', 'About the game:', 'Synopsis', 'Plot:', 'Description:', 'Story -']
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'caf&eacute;', 'na&iuml;ve',
+         '&amp;', 'story', 'about']
+PREFIXES = [1, 2, 3, 7, 13, 18, 19, 20, 22]
+PAGE = '''<!DOCTYPE html>
+<html lang="en-US"><head><meta charset="utf-8">
+<title>{title} | F95zone</title>
+<link rel="canonical" href="https://f95zone.to/threads/{slug}.{thread_id}/">
+<script>window.XF = {{"config": {{"url": "https://f95zone.to"}}}};</script>
+<style>.p-body {{ margin: 0; }}</style>
+</head><body>
+<div class="p-pageWrapper"><nav class="p-nav"><a href="/">Home</a><a href="/forums/">Forums</a></nav>
+<div uix_component="MainContent">
+<h1 class="p-title-value"><a class="labelLink" href="/forums/games.2/?prefix_id=7"><span class="label">Ren'Py</span></a> {title} [v{version}] [{developer}]</h1>
+<div class="tabs tabs--standalone"><div class="tabs-tab"><span class="hScroller-scroll"><a href="/threads/{thread_id}/">Information</a><a href="/threads/{thread_id}/br-reviews">Reviews ({votes})</a></span></div></div>
+<div class="inputGroup inputGroup--numbers"><div class="inputNumber"><input type="number" class="input" min="1" max="{pages}" value="1"></div></div>
+<a class="username " data-user-id="{user_id}" href="/members/user{user_id}.{user_id}/">Uploader {user_id}</a>
+<ul class="tagList"><li class="groupedTags">{tags}</li></ul>
+<select name="rating" class="br-select" data-initial-rating="{rating}"><option value="1">1</option></select>
+<time class="u-dt" data-time="{date}">{date}</time>
+<div class="message-content js-messageContent">
+{lastedit}
+<article class="message-body js-selectToQuote"><div class="bbWrapper">{body}</div></article>
+</div></div></div>
+<footer class="p-footer"><a href="https://f95zone.com/index.php?help/terms">Terms</a></footer>
+</body></html>
+'''
+
+
+def _sentence(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def generate_thread(seed, index):
+    """Returns (thread_id, html, listing entry) for one synthetic XenForo thread page."""
+    rng = random.Random(seed * 1000003 + index)
+    thread_id = FIRST_THREAD_ID + index * 7
+    developer = f"Studio {rng.randint(1, 60)}"
+    version = f"0.{rng.randint(1, 20)}.{rng.randint(0, 9)}"
+    title = f"Synthetic Game {thread_id}"
+    body = list()
+    body.append(f'<a class="js-lbImage" href="https://attachments.f95zone.to/thumb/{thread_id}_cover.png">'
+                f'<img src="x" alt="{thread_id}_cover.png"></a><noscript><img src="{thread_id}.png"></noscript>')
+    if rng.random() < 0.85:
+        heading = rng.choice(HEADINGS)
+        if rng.random() < 0.5:
+            body.append(f'{heading}<br>\n{_sentence(rng, 10, 80)}<br>\n{_sentence(rng, 3, 30)}<br>')
+        else:
+            body.append(f'{heading} {_sentence(rng, 10, 80)}<br>\n{_sentence(rng, 3, 30)}<br>')
+    else:
+        body.append(f'<i>{_sentence(rng, 1, 3)}</i>')
+    body.append(f'\n<b>Thread Updated</b>: 2020-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}<br>')
+    body.append(f'\n<b>Developer</b>: {developer} <a href="https://www.patreon.com/s{thread_id}" '
+                f'class="link link--external">Patreon</a><br>')
+    body.append(f'\n<b>Censored</b>: {rng.choice(["No", "Yes", "No (mosaic)"])}<br>')
+    body.append(f'\n<b>Version</b>: {version}<br>')
+    body.append(f'\n<b>OS</b>: {rng.choice(["Windows", "Windows, Linux, Mac", "Android"])}<br>')
+    body.append(f'\n<b>Language</b>: {rng.choice(["English", "English, Spanish"])}<br>')
+    hosts = rng.sample(['mega.nz', 'mixdrop.co', 'pixeldrain.com', 'workupload.com', 'gofile.io'], rng.randint(1, 4))
+    links = ' - '.join(f'<a href="https://{host}/{thread_id}" class="link link--external">{host}</a>'
+                       for host in hosts)
+    if rng.random() < 0.8:
+        body.append(f'\n<span style="font-size: 18px"><b>DOWNLOAD</b><br>\nWin/Linux: {links}</span>')
+    else:
+        body.append(f'\n<b>DOWNLOAD</b><br>\nWin/Linux: {links}')
+    for shot in range(rng.randint(0, 6)):
+        body.append(f'\n<a class="js-lbImage" href="https://attachments.f95zone.to/thumb/{thread_id}_{shot}.png">'
+                    f'<img src="x" alt="{thread_id}_{shot}.png"></a>')
+    date = 1500000000 + index * 3600
+    edited = date + rng.randint(0, 10 ** 7)
+    if rng.random() < 0.75:
+        lastedit = f'<div class="message-lastEdit">Last edited: <time data-time="{edited}">x</time></div>'
+    else:
+        lastedit = ''
+    tags = ''.join(f'<a href="/tags/{tag.replace(" ", "-")}/" class="tagItem">{tag}</a>'
+                   for tag in rng.sample(TAGS, rng.randint(1, 10)))
+    html = PAGE.format(thread_id=thread_id, slug=title.lower().replace(' ', '-'), title=title, version=version,
+                       developer=developer, votes=rng.randint(0, 300), pages=rng.randint(1, 900),
+                       user_id=rng.randint(1, 500), tags=tags, rating=round(rng.random() * 5, 2), date=date,
+                       lastedit=lastedit, body=''.join(body))
+    entry = {'thread_id': thread_id, 'title': title, 'creator': developer, 'developer': developer,
+             'version': version, 'views': rng.randint(100, 10 ** 6), 'likes': rng.randint(0, 5000),
+             'prefixes': sorted(rng.sample(PREFIXES, rng.randint(1, 3))), 'tags': [], 'rating': rng.randint(0, 50) / 10,
+             'images': {'cover': f'https://attachments.f95zone.to/{thread_id}_cover.png', 'screens': []},
+             'watched': False, 'ignored': False, 'new': False, 'ts': edited}
+    return thread_id, html, entry
+
+
+def generate_corpus(outdir, count, seed=1, listing_files=1):
+    """Writes count thread pages to outdir/pages and the matching listing dumps to outdir/JSON."""
+    pagedir = os.path.join(outdir, 'pages')
+    jsondir = os.path.join(outdir, 'JSON')
+    os.makedirs(pagedir, exist_ok=True)
+    os.makedirs(jsondir, exist_ok=True)
+    entries = list()
+    for index in range(count):
+        thread_id, html, entry = generate_thread(seed, index)
+        with open(os.path.join(pagedir, f'thread-{thread_id}.html'), 'w', encoding='UTF-8') as pagefile:
+            pagefile.write(html)
+        entries.append(entry)
+    per_file = -(-count // listing_files) if count else 0
+    for number in range(listing_files):
+        chunk = entries[number * per_file:(number + 1) * per_file]
+        with open(os.path.join(jsondir, f'latest_{number + 1}.json'), 'w') as jfp:
+            json.dump({'status': 'ok', 'msg': {'data': chunk, 'pagination': {'page': number + 1}}}, jfp)
+    return pagedir, jsondir
+
+
+def _normalize(record):
+    """Golden output is the parsed page fields gone through JSON, so compare in that form (tuples become lists)."""
+    return json.loads(json.dumps(record.to_dict(record.PAGE_FIELDS)))
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def bench_import(module='pageparse', runs=5):
+    """
+    Imports module in fresh interpreters started in an empty directory. Returns the best import time
+    in ms, the DEFERRED_MODULES the import loaded anyway and the files it left in the directory.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    code = IMPORT_PROBE.format(module=module, deferred=DEFERRED_MODULES)
+    best = None
+    with tempfile.TemporaryDirectory() as workdir:
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env, capture_output=True,
+                                    text=True, check=True).stdout.split('\n')
+            elapsed = float(output[0])
+            best = elapsed if best is None else min(best, elapsed)
+        return best, output[1].split(), os.listdir(workdir)
+
+
+def bench_parse(pagedir, engine):
+    """Parses every page in pagedir, returns (pages/sec, {thread_id: ThreadRecord})."""
+    import pageparse
+    tasks = list()
+    for file in sorted(os.listdir(pagedir)):
+        thread_id = int(file.split('.')[0].split('-')[1])
+        tasks.append((thread_id, os.path.join(pagedir, file), None))
+    results = dict()
+    started = time.perf_counter()
+    for thread_id, record, filestate in pageparse.iter_parsed(tasks, engine=engine):
+        results[thread_id] = record
+    elapsed = time.perf_counter() - started
+    return len(tasks) / elapsed, results
+
+
+def check_golden(results):
+    """Returns the thread ids whose parsed record differs from the golden output."""
+    with open(GOLDEN_PATH, 'r', encoding='UTF-8') as gfp:
+        golden = json.load(gfp)
+    return [int(thread_id) for thread_id, expected in golden.items()
+            if int(thread_id) in results and _normalize(results[int(thread_id)]) != expected]
+
+
+def update_golden(results):
+    golden = {thread_id: _normalize(results[thread_id]) for thread_id in sorted(results)[:GOLDEN_COUNT]}
+    with open(GOLDEN_PATH, 'w', encoding='UTF-8') as gfp:
+        json.dump(golden, gfp, indent=1, sort_keys=True, ensure_ascii=False)
+        gfp.write('\n')
+
+
+def bench_insert(results, jsondir, batch_size, db_profile='bulk'):
+    """Loads the parsed threads into a scratch database, returns threads/sec."""
+    import pageparse
+    from listing import load_listing
+    listing = load_listing(jsondir)
+    records = list()
+    for thread_id, record in results.items():
+        record = copy.copy(record)
+        pageparse.merge_listing(record, listing[thread_id])
+        records.append(record)
+    with tempfile.TemporaryDirectory() as dbdir:
+        engine = pageparse.init_db(os.path.join(dbdir, 'bench.db3'), db_profile)
+        started = time.perf_counter()
+        for i in range(0, len(records), batch_size):
+            pageparse.insert_threads(records[i:i + batch_size])
+        elapsed = time.perf_counter() - started
+        engine.dispose()
+    return len(records) / elapsed
+
+
+def main(count=GOLDEN_COUNT, seed=1, engines=('bs4', 'lxml'), batch_sizes=(1, 500), golden=True, update=False,
+         db_profile='bulk', import_budget=IMPORT_BUDGET_MS):
+    failed = False
+    elapsed, loaded, created = bench_import()
+    line = f"import  pageparse {elapsed:10.1f} ms"
+    if import_budget:
+        over = elapsed > import_budget or loaded or created
+        failed = failed or bool(over)
+        line += f"  (budget {import_budget} ms) " + ("OK" if not over else "OVER BUDGET")
+        if loaded:
+            line += f", loaded {' '.join(loaded)}"
+        if created:
+            line += f", created {' '.join(created)}"
+    print(line)
+    with tempfile.TemporaryDirectory() as corpusdir:
+        pagedir, jsondir = generate_corpus(corpusdir, count, seed)
+        print(f"corpus: {count} pages, seed {seed}")
+        results = None
+        for engine in engines:
+            rate, results = bench_parse(pagedir, engine)
+            line = f"parse   {engine:<5} {rate:10.1f} pages/sec"
+            if update and seed == 1 and engine == engines[0]:
+                update_golden(results)
+                line += "  golden updated"
+            elif (golden or update) and seed == 1:
+                mismatched = check_golden(results)
+                failed = failed or bool(mismatched)
+                line += "  golden OK" if not mismatched else f"  golden MISMATCH {mismatched[:10]}"
+            print(line)
+        for batch_size in batch_sizes:
+            rate = bench_insert(results, jsondir, batch_size, db_profile)
+            print(f"insert  batch={batch_size:<5} {rate:10.1f} threads/sec ({db_profile} profile)")
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"peak RSS {rss:.1f} MB")
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark parse_html and insert_threads on a synthetic corpus.")
+    parser.add_argument('--count', type=int, default=GOLDEN_COUNT, help="number of synthetic thread pages")
+    parser.add_argument('--seed', type=int, default=1, help="corpus seed; golden output only exists for seed 1")
+    parser.add_argument('--engine', action='append', choices=['bs4', 'lxml'],
+                        help="parse engine to benchmark, may be repeated (default: both)")
+    parser.add_argument('--batch-size', type=int, action='append',
+                        help="insert_threads batch size, may be repeated (default: 1 and 500)")
+    parser.add_argument('--db-profile', choices=['default', 'bulk', 'query'], default='bulk')
+    parser.add_argument('--no-golden', action='store_true', help="skip the golden output comparison")
+    parser.add_argument('--update-golden', action='store_true', help="rewrite bench_golden.json from this run")
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_MS,
+                        help="fail when importing pageparse takes longer (ms); 0 only reports the time")
+    args = parser.parse_args()
+    ok = main(count=args.count, seed=args.seed, engines=args.engine or ('bs4', 'lxml'),
+              batch_sizes=args.batch_size or (1, 500), golden=not args.no_golden, update=args.update_golden,
+              db_profile=args.db_profile, import_budget=args.import_budget)
+    sys.exit(0 if ok else 1)
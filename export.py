@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import argparse
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from f95_models import db_connect, read_prefixes, chunked, in_list, DEFAULT_DB_PATH
+
+
+STATE_FILE = 'export_state.json'
+CHUNK_ROWS = 5000
+ROWS_PER_FILE = 200000
+
+THREAD_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('canonical', pa.string()),
+    ('title', pa.string()),
+    ('user_id', pa.int64()),
+    ('user_name', pa.string()),
+    ('rating', pa.float64()),
+    ('date', pa.int64()),
+    ('edited', pa.int64()),
+    ('overview', pa.string()),
+    ('developer', pa.string()),
+    ('platform', pa.string()),
+    ('censorship', pa.string()),
+    ('language', pa.string()),
+    ('version', pa.string()),
+    ('views', pa.int64()),
+    ('likes', pa.int64()),
+    ('votes', pa.int64()),
+    ('pages', pa.int64()),
+    ('image_cover', pa.string()),
+    ('updated', pa.int64()),
+    ('tags', pa.list_(pa.string())),
+    ('prefix_ids', pa.list_(pa.int32())),
+    ('prefixes', pa.list_(pa.string())),
+    ('links', pa.list_(pa.string())),
+    ('images', pa.list_(pa.string())),
+])
+
+THREAD_ROWS = '''
+    SELECT thread.id, thread.canonical, thread.title, thread.user_id, user.name, thread.rating, thread.date,
+           thread.edited, thread.overview, developer.name, platform.name, thread.censorship, language.name,
+           thread.version, thread.views, thread.likes, thread.votes, thread.pages, thread.image_cover, thread.updated
+    FROM thread
+    LEFT JOIN user ON user.id = thread.user_id
+    LEFT JOIN developer ON developer.id = thread.developer_id
+    LEFT JOIN platform ON platform.id = thread.platform_id
+    LEFT JOIN language ON language.id = thread.language_id
+    WHERE thread.id > :after {where}
+    ORDER BY thread.id LIMIT :limit
+'''
+# List columns: name -> query returning (thread id, value...) in page order for a set of threads.
+LIST_ROWS = {
+    'tags': "SELECT threadtag.thread_id, tag.name FROM threadtag JOIN tag ON tag.id = threadtag.tag_id "
+            "WHERE threadtag.thread_id IN ({ids}) ORDER BY threadtag.id",
+    'prefixes': "SELECT threadprefix.thread_id, prefix.id, prefix.name FROM threadprefix "
+                "JOIN prefix ON prefix.id = threadprefix.prefix_id "
+                "WHERE threadprefix.thread_id IN ({ids}) ORDER BY threadprefix.id",
+    'links': "SELECT threadlink.thread_id, link.url FROM threadlink JOIN link ON link.id = threadlink.link_id "
+             "WHERE threadlink.thread_id IN ({ids}) ORDER BY threadlink.id",
+    'images': "SELECT threadimage.thread_id, image.url FROM threadimage JOIN image ON image.id = threadimage.image_id "
+              "WHERE threadimage.thread_id IN ({ids}) ORDER BY threadimage.id",
+}
+
+
+def _grouped(session, sql, thread_ids):
+    groups = {thread_id: list() for thread_id in thread_ids}
+    for chunk in chunked(thread_ids):
+        ids, params = in_list(chunk)
+        for row in session.execute(text(sql.format(ids=ids)), params):
+            groups[row[0]].append(row[1:])
+    return groups
+
+
+def iter_batches(session, since=None, chunk_rows=CHUNK_ROWS):
+    """
+    Yields the catalogue as Arrow record batches of at most chunk_rows threads, walking thread ids
+    in order so only one chunk is in memory. With since set, only threads written after it are read.
+    """
+    where = "" if since is None else "AND thread.updated > :since"
+    sql = text(THREAD_ROWS.format(where=where))
+    after = -1
+    while True:
+        rows = session.execute(sql, {'after': after, 'limit': chunk_rows, 'since': since}).fetchall()
+        if not rows:
+            return
+        thread_ids = [row[0] for row in rows]
+        columns = {name: list(values) for name, values in zip(THREAD_SCHEMA.names, zip(*rows))}
+        lists = {name: _grouped(session, sql_list, thread_ids) for name, sql_list in LIST_ROWS.items()}
+        columns['tags'] = [[name for name, in lists['tags'][thread_id]] for thread_id in thread_ids]
+        columns['prefix_ids'] = [[prefix_id for prefix_id, name in lists['prefixes'][thread_id]]
+                                 for thread_id in thread_ids]
+        columns['prefixes'] = [[name for prefix_id, name in lists['prefixes'][thread_id]] for thread_id in thread_ids]
+        columns['links'] = [[url for url, in lists['links'][thread_id]] for thread_id in thread_ids]
+        columns['images'] = [[url for url, in lists['images'][thread_id]] for thread_id in thread_ids]
+        yield pa.RecordBatch.from_pydict(columns, schema=THREAD_SCHEMA)
+        after = thread_ids[-1]
+
+
+def record_batch(records, prefix_names=None, updated=None):
+    """
+    The same record batch as iter_batches for parsed ThreadRecords that never went through the
+    database, e.g. in a streaming pipeline. prefix_names maps prefix id -> name and defaults to prefixes.txt.
+    """
+    if prefix_names is None:
+        prefix_names = {row['id']: row['name'] for row in read_prefixes()}
+    updated = time.time_ns() if updated is None else updated
+    columns = {name: [getattr(record, name, None) for record in records] for name in THREAD_SCHEMA.names}
+    columns['updated'] = [updated] * len(records)
+    columns['tags'] = [[name for name, url in record.tags] for record in records]
+    columns['prefix_ids'] = [list(record.prefixes or ()) for record in records]
+    columns['prefixes'] = [[prefix_names.get(prefix_id) for prefix_id in prefix_ids]
+                           for prefix_ids in columns['prefix_ids']]
+    columns['links'] = [list(record.downloadlinks) for record in records]
+    columns['images'] = [[url for name, url in record.images] for record in records]
+    return pa.RecordBatch.from_pydict(columns, schema=THREAD_SCHEMA)
+
+
+def load_state(outdir):
+    try:
+        with open(os.path.join(outdir, STATE_FILE), 'r') as statefile:
+            return json.load(statefile)
+    except FileNotFoundError:
+        return {'updated': None, 'runs': 0}
+
+
+def save_state(outdir, state):
+    with open(os.path.join(outdir, STATE_FILE), 'w') as statefile:
+        json.dump(state, statefile, indent=1)
+
+
+class _PartWriter:
+    """Rolls Parquet (or Arrow IPC) part files over every rows_per_file rows."""
+
+    def __init__(self, outdir, run, fmt, rows_per_file, compression):
+        self.outdir = outdir
+        self.run = run
+        self.fmt = fmt
+        self.rows_per_file = rows_per_file
+        self.compression = compression
+        self.writer = None
+        self.sink = None
+        self.rows = 0
+        self.paths = list()
+
+    def _open(self):
+        extension = 'parquet' if self.fmt == 'parquet' else 'arrow'
+        path = os.path.join(self.outdir, f'part-{self.run:05d}-{len(self.paths):05d}.{extension}')
+        self.paths.append(path)
+        if self.fmt == 'parquet':
+            self.writer = pq.ParquetWriter(path, THREAD_SCHEMA, compression=self.compression)
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = ipc.new_file(self.sink, THREAD_SCHEMA)
+        self.rows = 0
+
+    def write(self, batch):
+        if self.writer is None or self.rows >= self.rows_per_file:
+            self.close()
+            self._open()
+        self.writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+
+def export(session, outdir, fmt='parquet', incremental=False, chunk_rows=CHUNK_ROWS, rows_per_file=ROWS_PER_FILE,
+           compression='zstd'):
+    """
+    Writes the thread catalogue to part files in outdir and returns the number of threads written.
+    A full export replaces the earlier parts; an incremental one appends a new run holding only the
+    threads written since the last export. Readers keep the row with the newest 'updated' per id.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    state = load_state(outdir)
+    if not incremental or state['updated'] is None:
+        for name in os.listdir(outdir):
+            if name.startswith('part-'):
+                os.remove(os.path.join(outdir, name))
+        state = {'updated': None, 'runs': 0}
+    # Threads written while the export runs are picked up by the next one.
+    high_water, = session.execute(text("SELECT max(updated) FROM thread")).fetchone()
+    writer = _PartWriter(outdir, state['runs'], fmt, rows_per_file, compression)
+    count = 0
+    try:
+        for batch in iter_batches(session, state['updated'], chunk_rows):
+            writer.write(batch)
+            count += batch.num_rows
+    finally:
+        writer.close()
+    state['runs'] += 1
+    if high_water is not None:
+        state['updated'] = high_water if state['updated'] is None else max(state['updated'], high_water)
+    state['exported'] = time.time()
+    save_state(outdir, state)
+    return count
+
+
+def read_catalogue(outdir, columns=None):
+    """
+    Reads every part in outdir into one Arrow table with the latest copy of each thread. Arrow IPC
+    parts are memory-mapped rather than read.
+    """
+    tables = list()
+    for name in sorted(os.listdir(outdir)):
+        path = os.path.join(outdir, name)
+        if name.endswith('.parquet'):
+            tables.append(pq.read_table(path, columns=columns and sorted(set(columns) | {'id', 'updated'})))
+        elif name.endswith('.arrow'):
+            table = ipc.open_file(pa.memory_map(path, 'r')).read_all()
+            tables.append(table if columns is None else table.select(sorted(set(columns) | {'id', 'updated'})))
+    if not tables:
+        return THREAD_SCHEMA.empty_table()
+    table = pa.concat_tables(tables)
+    if len(tables) == 1:
+        return table
+    # Later runs come later in the table; keep the last row per id.
+    ids = table.column('id').to_pylist()
+    last = {thread_id: position for position, thread_id in enumerate(ids)}
+    return table.take(sorted(last.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the thread catalogue to Parquet or Arrow IPC files.")
+    parser.add_argument('outdir', help="directory for the part files and export state")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--incremental', action='store_true',
+                        help="append only the threads written since the last export to this directory")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help="threads read and written per batch")
+    parser.add_argument('--rows-per-file', type=int, default=ROWS_PER_FILE)
+    parser.add_argument('--compression', default='zstd', help="Parquet codec")
+    args = parser.parse_args()
+    session = sessionmaker(bind=db_connect(args.db, 'query'))()
+    started = time.perf_counter()
+    written = export(session, args.outdir, args.format, args.incremental, args.chunk_rows, args.rows_per_file,
+                     args.compression)
+    print(f"{written} threads exported to {args.outdir} in {time.perf_counter() - started:.2f}s")
+    session.close()
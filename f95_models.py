@@ -1,21 +1,135 @@
+import os
 from sqlalchemy import Column, ForeignKey, Integer, Boolean, Float, Text, UniqueConstraint, DateTime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 
 Base = declarative_base()
 
-
-def db_connect():
+DEFAULT_DB_PATH = 'f95.db3'
+PREFIXES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prefixes.txt')
+# Stay below SQLite's default limit on bound parameters per statement.
+IN_CHUNK = 900
+# PRAGMAs applied to every new connection. 'bulk' trades durability for load speed (a crashed load is
+# simply re-run), 'query' is for read-heavy serving.
+SQLITE_PROFILES = {
+    'default': {},
+    'bulk': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -262144,
+        'mmap_size': 1073741824,
+        'temp_store': 'MEMORY',
+    },
+    'query': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,
+        'mmap_size': 1073741824,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def db_connect(path=DEFAULT_DB_PATH, profile='default'):
     """
-    Performs database connection using database settings from settings.py.
+    Performs database connection to the SQLite file at path, tuned with one of SQLITE_PROFILES.
     Returns sqlalchemy engine instance
     """
-    return create_engine(r'sqlite:///f95.db3')
+    engine = create_engine(f'sqlite:///{path}')
+    pragmas = SQLITE_PROFILES[profile]
+    if pragmas:
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+    return engine
+
+
+def chunked(items, size=IN_CHUNK):
+    """Splits items into lists of at most size, e.g. for IN (...) lists of bound parameters."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def in_list(values, name='id'):
+    """Placeholders and bound parameters for an IN (...) list: (':id0, :id1', {'id0': ..., 'id1': ...})."""
+    params = {f'{name}{n}': value for n, value in enumerate(values)}
+    return ', '.join(f':{key}' for key in params), params
 
 
-def create_tables(engine):
-    """"""
+def int_rows(connection, sql, params=None, columns=2):
+    """The rows of a query over integer columns as an (n, columns) int64 NumPy array."""
+    import numpy as np
+    from itertools import chain
+    rows = connection.execute(text(sql), params or dict())
+    # np.fromiter over the flattened rows avoids NumPy probing every Row as a sequence.
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, columns)
+
+
+def create_tables(engine, indexes=True):
+    """
+    Creates missing tables and columns and, with indexes set, any missing secondary index, which
+    create_all skips on tables that already exist. Bulk loads leave the indexes to create_indexes.
+    """
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    if indexes:
+        create_indexes(engine, analyze=False)
+
+
+def add_missing_columns(engine):
+    """Adds model columns that a database file created by an older version lacks, with their indexes."""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        present = {column['name'] for column in inspector.get_columns(table.name)}
+        added = [column for column in table.columns if column.name not in present]
+        if not added:
+            continue
+        with engine.begin() as connection:
+            for column in added:
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" '
+                                        f'{column.type.compile(engine.dialect)}'))
+        for index in table.indexes:
+            if any(column in added for column in index.columns):
+                index.create(bind=engine, checkfirst=True)
+
+
+def read_prefixes(path=PREFIXES_PATH):
+    """The forum's prefix ids and names from a tab separated file, one per line, as dicts with id and name."""
+    rows = list()
+    with open(path, 'r', encoding='UTF-8') as prefixfile:
+        for line in prefixfile:
+            if line.strip():
+                prefix_id, name = line.rstrip('\n').split('\t', 1)
+                rows.append({'id': int(prefix_id), 'name': name})
+    return rows
+
+
+def seed_prefixes(engine, path=PREFIXES_PATH):
+    """Loads the prefixes in path into the prefix table."""
+    with engine.begin() as connection:
+        connection.execute(Prefix.__table__.insert().prefix_with('OR IGNORE'), read_prefixes(path))
+
+
+def drop_indexes(engine):
+    """Drops the secondary indexes so a bulk load does not maintain them row by row."""
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                connection.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+
+
+def create_indexes(engine, analyze=True):
+    """Builds any missing secondary indexes, e.g. after a bulk load, and refreshes the planner statistics."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    if analyze:
+        with engine.begin() as connection:
+            connection.execute(text('ANALYZE'))
 
 
 class User(Base):
@@ -76,15 +190,15 @@ class Thread(Base):
     id = Column(Integer, primary_key=True)
     canonical = Column(Text)
     title = Column(Text)
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     rating = Column(Float)
     date = Column(Integer)
     edited = Column(Integer)
     overview = Column(Text)
-    developer_id = Column(Integer, ForeignKey('developer.id'))
-    platform_id = Column(Integer, ForeignKey('platform.id'))
+    developer_id = Column(Integer, ForeignKey('developer.id'), index=True)
+    platform_id = Column(Integer, ForeignKey('platform.id'), index=True)
     censorship = Column(Text)
-    language_id = Column(Integer, ForeignKey('language.id'))
+    language_id = Column(Integer, ForeignKey('language.id'), index=True)
     version = Column(Text)
     views = Column(Integer)
     likes = Column(Integer)
@@ -92,13 +206,17 @@ class Thread(Base):
     prefixes = Column(Text)
     pages = Column(Integer)
     image_cover = Column(Text)
+    # time.time_ns() of the last write, for incremental exports.
+    updated = Column(Integer, index=True)
+    # library.title_key(title), what local game folders are matched against.
+    title_key = Column(Text, index=True)
 
 
 class ThreadImage(Base):
     __tablename__ = 'threadimage'
     id = Column(Integer, primary_key=True)
     thread_id = Column(Integer, ForeignKey('thread.id'))
-    image_id = Column(Integer, ForeignKey('image.id'))
+    image_id = Column(Integer, ForeignKey('image.id'), index=True)
     __table_args__ = (UniqueConstraint('thread_id', 'image_id', name='thread_image_key'),)
 
 
@@ -106,7 +224,7 @@ class ThreadLink(Base):
     __tablename__ = 'threadlink'
     id = Column(Integer, primary_key=True)
     thread_id = Column(Integer, ForeignKey('thread.id'))
-    link_id = Column(Integer, ForeignKey('link.id'))
+    link_id = Column(Integer, ForeignKey('link.id'), index=True)
     __table_args__ = (UniqueConstraint('thread_id', 'link_id', name='thread_link_key'),)
 
 
@@ -114,7 +232,7 @@ class ThreadTag(Base):
     __tablename__ = 'threadtag'
     id = Column(Integer, primary_key=True)
     thread_id = Column(Integer, ForeignKey('thread.id'))
-    tag_id = Column(Integer, ForeignKey('tag.id'))
+    tag_id = Column(Integer, ForeignKey('tag.id'), index=True)
     __table_args__ = (UniqueConstraint('thread_id', 'tag_id', name='thread_tag_key'),)
 
 
@@ -122,12 +240,47 @@ class ThreadPrefix(Base):
     __tablename__ = 'threadprefix'
     id = Column(Integer, primary_key=True)
     thread_id = Column(Integer, ForeignKey('thread.id'))
-    prefix_id = Column(Integer, ForeignKey('prefix.id'))
+    prefix_id = Column(Integer, ForeignKey('prefix.id'), index=True)
     __table_args__ = (UniqueConstraint('thread_id', 'prefix_id', name='thread_prefix_key'),)
 
 
 class Downloaded(Base):
+    """A game folder or archive in the local library, see library.py."""
     __tablename__ = 'downloaded'
     id = Column(Integer, primary_key=True)
     path = Column(Text, unique=True)
     version = Column(Text)
+    thread_id = Column(Integer, ForeignKey('thread.id'), index=True)
+    title_key = Column(Text, index=True)
+    # Newest mtime (ns) of the entry and its top-level files when it was last read.
+    mtime = Column(Integer)
+    # How closely the title matched the thread's, 1.0 for an exact key match.
+    score = Column(Float)
+
+
+class Manifest(Base):
+    __tablename__ = 'manifest'
+    thread_id = Column(Integer, primary_key=True)
+    path = Column(Text)
+    size = Column(Integer)
+    mtime = Column(Integer)
+    hash = Column(Text)
+    edited = Column(Integer)
+    etag = Column(Text)
+    last_modified = Column(Text)
+
+
+class Snapshot(Base):
+    """Thread metrics as of one ingest run, written only when they changed since the previous snapshot."""
+    __tablename__ = 'snapshot'
+    thread_id = Column(Integer, primary_key=True)
+    taken = Column(Integer, primary_key=True)
+    views = Column(Integer)
+    likes = Column(Integer)
+    votes = Column(Integer)
+    # Rating times 100, so the row stays all integers.
+    rating = Column(Integer)
+    version = Column(Text)
+    edited = Column(Integer)
+    # Clustered on (thread_id, taken), so history and latest-before lookups are primary key range seeks.
+    __table_args__ = {'sqlite_with_rowid': False}
@@ -0,0 +1,281 @@
+import argparse
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from f95_models import db_connect, chunked, in_list, DEFAULT_DB_PATH
+
+
+# facet -> (thread id, value id) pairs, value id -> name. The "prefix" facet covers both status
+# (Completed, Abandoned, ...) and engine (Ren'Py, Unity, ...) prefixes.
+FACET_SOURCES = {
+    'tag': ("SELECT thread_id, tag_id FROM threadtag", "SELECT id, name FROM tag"),
+    'prefix': ("SELECT thread_id, prefix_id FROM threadprefix", "SELECT id, name FROM prefix"),
+    'platform': ("SELECT id, platform_id FROM thread WHERE platform_id IS NOT NULL", "SELECT id, name FROM platform"),
+}
+PAIR_FILTERS = {
+    'tag': "thread_id",
+    'prefix': "thread_id",
+    'platform': "id",
+}
+# Set bits per byte value, for counting packed bitmaps.
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint32)
+
+
+def _positions_mask(positions, nbytes):
+    bits = np.zeros(nbytes * 8, dtype=bool)
+    bits[positions] = True
+    return np.packbits(bits)
+
+
+class Facet:
+    """One facet: a packed bitmap over thread positions for every value, one row per value."""
+
+    def __init__(self, nbytes):
+        self.keys = list()
+        self.rows = dict()
+        self.names = dict()
+        self.lookup = dict()
+        # Rows are allocated in doubling blocks; bits is the view over the rows in use.
+        self.block = np.zeros((0, nbytes), dtype=np.uint8)
+
+    @property
+    def bits(self):
+        return self.block[:len(self.keys)]
+
+    @bits.setter
+    def bits(self, bits):
+        self.block = bits
+
+    def set_names(self, names):
+        for key, name in names:
+            self.names[key] = name
+            if name is not None:
+                self.lookup[name.casefold()] = key
+
+    def _row(self, key):
+        try:
+            return self.rows[key]
+        except KeyError:
+            if len(self.keys) == len(self.block):
+                self.block = np.pad(self.block, ((0, max(len(self.block), 16)), (0, 0)))
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            return self.rows[key]
+
+    def grow(self, nbytes):
+        if nbytes > self.block.shape[1]:
+            self.block = np.pad(self.block, ((0, 0), (0, nbytes - self.block.shape[1])))
+
+    def add(self, pairs):
+        """Sets the bits for an array of (position, value id) pairs."""
+        if not len(pairs):
+            return
+        order = np.argsort(pairs[:, 1], kind='stable')
+        pairs = pairs[order]
+        keys, starts = np.unique(pairs[:, 1], return_index=True)
+        for key, positions in zip(keys.tolist(), np.split(pairs[:, 0], starts[1:])):
+            row = self._row(key)
+            self.bits[row] |= _positions_mask(positions, self.bits.shape[1])
+
+    def clear(self, mask):
+        self.block &= ~mask
+
+    def bitmap(self, name):
+        """Packed bitmap of a value by name (case-insensitive); an unknown value matches nothing."""
+        key = self.lookup.get(name.casefold())
+        if key is None or key not in self.rows:
+            return np.zeros(self.bits.shape[1], dtype=np.uint8)
+        return self.bits[self.rows[key]]
+
+
+class FacetIndex:
+    """
+    In-memory facet engine over the thread catalogue. Every tag, prefix and platform keeps a packed
+    bitmap (one bit per thread) so boolean filters are byte-wise AND/OR/NOT over NumPy arrays and
+    facet counts are popcounts, with no joins against the association tables.
+    """
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.positions = dict()
+        self.rating = np.zeros(0, dtype=np.float32)
+        self.count = 0
+        self.facets = {facet: Facet(0) for facet in FACET_SOURCES}
+
+    @property
+    def nbytes(self):
+        return len(self.ids) // 8
+
+    @classmethod
+    def build(cls, session):
+        index = cls()
+        index.update(session)
+        return index
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+        capacity += -capacity % 8
+        self.ids = np.pad(self.ids, (0, capacity - len(self.ids)))
+        self.rating = np.pad(self.rating, (0, capacity - len(self.rating)), constant_values=np.nan)
+        for facet in self.facets.values():
+            facet.grow(capacity // 8)
+
+    def _position(self, thread_id):
+        try:
+            return self.positions[thread_id]
+        except KeyError:
+            position = self.positions[thread_id] = self.count
+            self.ids[position] = thread_id
+            self.count += 1
+            return position
+
+    def update(self, session, thread_ids=None):
+        """(Re)loads the given threads, or every thread when thread_ids is None."""
+        where = ""
+        chunks = [None] if thread_ids is None else list(chunked(thread_ids))
+        for chunk in chunks:
+            params = dict()
+            if chunk is not None:
+                ids, params = in_list(chunk)
+                where = f" IN ({ids})"
+            rows = session.execute(text("SELECT id, rating FROM thread" + (f" WHERE id{where}" if where else "")),
+                                   params).fetchall()
+            self._grow(self.count + len(rows))
+            positions = [self._position(thread_id) for thread_id, rating in rows]
+            self.rating[positions] = [np.nan if rating is None else rating for thread_id, rating in rows]
+            if chunk is not None:
+                stale = _positions_mask(positions, self.nbytes)
+                for facet in self.facets.values():
+                    facet.clear(stale)
+            for name, (pairs_sql, names_sql) in FACET_SOURCES.items():
+                facet = self.facets[name]
+                if where:
+                    glue = " AND " if " WHERE " in pairs_sql else " WHERE "
+                    pairs_sql = f"{pairs_sql}{glue}{PAIR_FILTERS[name]}{where}"
+                pairs = session.execute(text(pairs_sql), params).fetchall()
+                pairs = np.array([(self.positions[thread_id], key) for thread_id, key in pairs
+                                  if thread_id in self.positions], dtype=np.int64).reshape(-1, 2)
+                facet.add(pairs)
+        for name, (pairs_sql, names_sql) in FACET_SOURCES.items():
+            self.facets[name].set_names(session.execute(text(names_sql)).fetchall())
+
+    def _facet(self, name):
+        try:
+            return self.facets[name]
+        except KeyError:
+            raise ValueError(f"Unknown facet {name!r}, expected one of {sorted(self.facets)}") from None
+
+    def select(self, all_of=None, any_of=None, none_of=None, min_rating=None, max_rating=None):
+        """
+        Returns the packed bitmap of threads matching every filter. all_of, any_of and none_of map a
+        facet name to value names, e.g. all_of={'tag': ['Sandbox', 'Romance'], 'prefix': ["Ren'Py"]}.
+        """
+        mask = np.packbits(np.arange(self.nbytes * 8) < self.count)
+        for facet, names in (all_of or dict()).items():
+            for name in names:
+                mask &= self._facet(facet).bitmap(name)
+        for facet, names in (any_of or dict()).items():
+            anymask = np.zeros(self.nbytes, dtype=np.uint8)
+            for name in names:
+                anymask |= self._facet(facet).bitmap(name)
+            mask &= anymask
+        for facet, names in (none_of or dict()).items():
+            for name in names:
+                mask &= ~self._facet(facet).bitmap(name)
+        if min_rating is not None:
+            mask &= np.packbits(self.rating > min_rating)
+        if max_rating is not None:
+            mask &= np.packbits(self.rating < max_rating)
+        return mask
+
+    def thread_ids(self, mask):
+        return self.ids[np.flatnonzero(np.unpackbits(mask))].tolist()
+
+    def total(self, mask):
+        return int(POPCOUNT[mask].sum())
+
+    def counts(self, mask, facet):
+        """Number of matching threads per value of a facet, largest first, zero counts left out."""
+        facet = self._facet(facet)
+        totals = POPCOUNT[facet.bits & mask].sum(axis=1)
+        counts = [(facet.names.get(key, key), int(total)) for key, total in zip(facet.keys, totals) if total]
+        return sorted(counts, key=lambda item: (-item[1], str(item[0])))
+
+    def save(self, path):
+        arrays = {'ids': self.ids[:self.count], 'rating': self.rating[:self.count]}
+        for name, facet in self.facets.items():
+            arrays[f'{name}_keys'] = np.array(facet.keys, dtype=np.int64)
+            arrays[f'{name}_bits'] = facet.bits
+        # Through a file object, as np.savez would append .npz to a path without it and load would miss it.
+        with open(path, 'wb') as indexfile:
+            np.savez(indexfile, **arrays)
+
+    @classmethod
+    def load(cls, path, session):
+        """Loads a saved index; value names are re-read from the database."""
+        index = cls()
+        with np.load(path) as arrays:
+            ids = arrays['ids']
+            index._grow(len(ids))
+            index.ids[:len(ids)] = ids
+            index.rating[:len(ids)] = arrays['rating']
+            index.count = len(ids)
+            index.positions = {thread_id: position for position, thread_id in enumerate(ids.tolist())}
+            for name, facet in index.facets.items():
+                facet.keys = arrays[f'{name}_keys'].tolist()
+                facet.rows = {key: row for row, key in enumerate(facet.keys)}
+                bits = arrays[f'{name}_bits']
+                facet.bits = np.zeros((len(facet.keys), index.nbytes), dtype=np.uint8)
+                facet.bits[:, :bits.shape[1]] = bits
+        for name, (pairs_sql, names_sql) in FACET_SOURCES.items():
+            index.facets[name].set_names(session.execute(text(names_sql)).fetchall())
+        return index
+
+
+def update_facet_index(path, session, thread_ids):
+    """Applies freshly ingested threads to a saved index, building it from scratch if it does not exist."""
+    try:
+        index = FacetIndex.load(path, session)
+    except FileNotFoundError:
+        index = FacetIndex.build(session)
+    else:
+        index.update(session, thread_ids)
+    index.save(path)
+    return index
+
+
+def _pairs(values):
+    result = dict()
+    for value in values or list():
+        facet, name = value.split('=', 1)
+        result.setdefault(facet, list()).append(name)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Filter threads by tag/prefix/platform with facet counts.")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--index', help="saved facet index (.npz); built from the database when missing")
+    parser.add_argument('--all', action='append', metavar='FACET=NAME', help="required value, e.g. tag=Sandbox")
+    parser.add_argument('--any', action='append', metavar='FACET=NAME', help="at least one of these values")
+    parser.add_argument('--not', dest='none', action='append', metavar='FACET=NAME', help="excluded value")
+    parser.add_argument('--min-rating', type=float)
+    parser.add_argument('--counts', action='append', choices=sorted(FACET_SOURCES), default=None)
+    parser.add_argument('--limit', type=int, default=50, help="thread ids to print")
+    args = parser.parse_args()
+    session = sessionmaker(bind=db_connect(args.db, 'query'))()
+    if args.index:
+        try:
+            facet_index = FacetIndex.load(args.index, session)
+        except FileNotFoundError:
+            facet_index = FacetIndex.build(session)
+            facet_index.save(args.index)
+    else:
+        facet_index = FacetIndex.build(session)
+    selected = facet_index.select(_pairs(args.all), _pairs(args.any), _pairs(args.none), args.min_rating)
+    print(f"{facet_index.total(selected)} threads:", facet_index.thread_ids(selected)[:args.limit])
+    for facet_name in args.counts or sorted(FACET_SOURCES):
+        print(f"{facet_name}:", facet_index.counts(selected, facet_name)[:20])
@@ -0,0 +1,291 @@
+import os
+import sys
+import random
+import asyncio
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from manifest import content_hash, decode_page
+
+
+BASE_URL = 'https://f95zone.to'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+FetchResult = namedtuple('FetchResult', ['thread_id', 'url', 'status', 'body', 'etag', 'last_modified', 'path'])
+FetchResult.__doc__ = """One fetched thread page. body is None for 304 Not Modified and for failed fetches."""
+
+
+def thread_url(base_url, thread_id):
+    return f"{base_url.rstrip('/')}/threads/{thread_id}/"
+
+
+class RateLimiter:
+    """Spaces request starts at least 1/rate seconds apart; a rate of 0 means unlimited."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            if self.next_at > now:
+                await asyncio.sleep(self.next_at - now)
+                now = self.next_at
+            self.next_at = now + self.interval
+
+
+class PageFetcher:
+    """
+    Fetches thread pages over a pooled aiohttp connection with a global and a per-host concurrency
+    limit, per-host rate limiting, retries with exponential backoff, and conditional requests from
+    known ETag/Last-Modified validators. Pages stay in memory unless save_dir is given.
+    """
+
+    def __init__(self, base_url=BASE_URL, concurrency=8, per_host=4, rate=2.0, retries=4, backoff=1.0, timeout=60,
+                 validators=None, save_dir=None, headers=None, cookies=None):
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.validators = validators if validators is not None else dict()
+        self.save_dir = save_dir
+        self.headers = headers or {'User-Agent': 'f95 page fetcher'}
+        self.cookies = cookies
+        self.limiters = dict()
+
+    def _limiter(self, url):
+        host = urlsplit(url).netloc
+        try:
+            return self.limiters[host]
+        except KeyError:
+            limiter = self.limiters[host] = RateLimiter(self.rate)
+            return limiter
+
+    def _delay(self, attempt, response=None):
+        if response is not None:
+            try:
+                return float(response.headers['Retry-After'])
+            except (KeyError, ValueError):
+                pass
+        return self.backoff * 2 ** attempt * (0.5 + random.random())
+
+    def _save(self, thread_id, body):
+        path = os.path.join(self.save_dir, f"thread-{thread_id}.html")
+        with open(path, 'wb') as pagefile:
+            pagefile.write(body)
+        return path
+
+    async def fetch(self, session, thread_id):
+        url = thread_url(self.base_url, thread_id)
+        headers = dict()
+        etag, last_modified = self.validators.get(thread_id, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        status = None
+        for attempt in range(self.retries + 1):
+            await self._limiter(url).wait()
+            try:
+                async with session.get(url, headers=headers) as response:
+                    status = response.status
+                    if status in RETRY_STATUSES and attempt < self.retries:
+                        await asyncio.sleep(self._delay(attempt, response))
+                        continue
+                    if status == 304:
+                        return FetchResult(thread_id, url, status, None, etag, last_modified, None)
+                    if status != 200:
+                        break
+                    body = await response.read()
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if attempt < self.retries:
+                    await asyncio.sleep(self._delay(attempt))
+                    continue
+                print("Fetch failed:", url, repr(error))
+                return FetchResult(thread_id, url, None, None, None, None, None)
+            path = None
+            if self.save_dir is not None:
+                path = await asyncio.get_running_loop().run_in_executor(None, self._save, thread_id, body)
+            return FetchResult(thread_id, url, status, body, etag, last_modified, path)
+        print("Fetch failed:", url, status)
+        return FetchResult(thread_id, url, status, None, None, None, None)
+
+    async def fetch_all(self, thread_ids, queue_size=64):
+        """
+        Async generator of FetchResults in completion order. At most queue_size finished pages wait
+        for the consumer; the fetch workers block once it is full.
+        """
+        pending = asyncio.Queue()
+        for thread_id in thread_ids:
+            pending.put_nowait(thread_id)
+        done = asyncio.Queue(maxsize=queue_size)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers,
+                                         cookies=self.cookies) as session:
+            async def worker():
+                while True:
+                    try:
+                        thread_id = pending.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    await done.put(await self.fetch(session, thread_id))
+
+            async def supervise():
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    await done.put(None)
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+            supervisor = asyncio.ensure_future(supervise())
+            try:
+                while True:
+                    result = await done.get()
+                    if result is None:
+                        break
+                    yield result
+                await supervisor
+            finally:
+                for task in workers + [supervisor]:
+                    task.cancel()
+
+
+def parse_page(engine, thread_id, url, body):
+    """Parses fetched page bytes; module level so it can run in a process pool."""
+    from pageparse import PARSE_ENGINES
+    return PARSE_ENGINES[engine](thread_id, url, decode_page(body))
+
+
+async def fetch_and_parse(fetcher, thread_ids, workers=1, engine='lxml', queue_size=64):
+    """
+    Async generator of (FetchResult, ThreadRecord), parsing pages in a process pool (or a thread when
+    workers is 1) while further pages are still downloading. The record is None when there was no body.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ProcessPoolExecutor(workers) if workers > 1 else ThreadPoolExecutor(1)
+    parsing = dict()
+    try:
+        async for result in fetcher.fetch_all(thread_ids, queue_size):
+            if result.body is None:
+                yield result, None
+                continue
+            future = loop.run_in_executor(executor, parse_page, engine, result.thread_id, result.url, result.body)
+            parsing[future] = result
+            if len(parsing) >= queue_size:
+                finished, pending = await asyncio.wait(parsing, return_when=asyncio.FIRST_COMPLETED)
+                for future in finished:
+                    yield parsing.pop(future), future.result()
+        while parsing:
+            finished, pending = await asyncio.wait(parsing, return_when=asyncio.FIRST_COMPLETED)
+            for future in finished:
+                yield parsing.pop(future), future.result()
+    finally:
+        executor.shutdown(wait=False)
+
+
+class StubPageHandler(BaseHTTPRequestHandler):
+    """Serves saved thread-<id>.html pages at /threads/<id>/ with ETag and Last-Modified support."""
+    pages = dict()
+
+    def do_GET(self):
+        parts = [part for part in self.path.split('/') if part]
+        try:
+            thread_id = int(parts[1].rsplit('.', 1)[-1])
+            fpath = self.pages[thread_id]
+        except (IndexError, ValueError, KeyError):
+            self.send_error(404)
+            return
+        with open(fpath, 'rb') as pagefile:
+            body = pagefile.read()
+        etag = f'"{content_hash(body)}"'
+        last_modified = formatdate(os.stat(fpath).st_mtime, usegmt=True)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stub_server(download_dir, host='127.0.0.1', port=0):
+    """A local HTTP server standing in for the forum, serving the saved pages in download_dir."""
+    pages = dict()
+    for file in os.listdir(download_dir):
+        try:
+            pages[int(file.split('.')[0].split('-')[1])] = os.path.join(download_dir, file)
+        except (IndexError, ValueError):
+            continue
+    handler = type('StubPages', (StubPageHandler,), {'pages': pages})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def refresh(thread_ids, fetcher, workers, engine, jsondir, batch_size, db_path='f95.db3', db_profile='default'):
+    """Fetches, parses and stores the given threads, remembering validators for the next refresh."""
+    from pipeline import run
+    written, counts = run('fetch', jsondir=jsondir, thread_ids=thread_ids, fetcher=fetcher, workers=workers,
+                          engine=engine, batch_size=batch_size, db_path=db_path, db_profile=db_profile)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fetch thread pages and feed them straight into the parser.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    fetch = sub.add_parser('fetch', help="fetch, parse and store threads")
+    fetch.add_argument('thread_ids', type=int, nargs='*', help="thread ids; defaults to every id in the listing")
+    fetch.add_argument('--json-dir', default=os.path.join(os.getcwd(), 'JSON'), help="listing dumps to merge")
+    fetch.add_argument('--base-url', default=BASE_URL)
+    fetch.add_argument('--concurrency', type=int, default=8)
+    fetch.add_argument('--per-host', type=int, default=4)
+    fetch.add_argument('--rate', type=float, default=2.0, help="requests per second per host, 0 for unlimited")
+    fetch.add_argument('--retries', type=int, default=4)
+    fetch.add_argument('--save-dir', help="also keep the fetched pages here")
+    fetch.add_argument('--workers', type=int, default=1, help="parser processes")
+    fetch.add_argument('--engine', choices=['bs4', 'lxml'], default='lxml')
+    fetch.add_argument('--batch-size', type=int, default=500)
+    fetch.add_argument('--db', default='f95.db3')
+    fetch.add_argument('--db-profile', choices=['default', 'bulk', 'query'], default='default')
+    serve = sub.add_parser('serve', help="serve saved pages from a local stub server")
+    serve.add_argument('download_dir')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8095)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = stub_server(args.download_dir, args.host, args.port)
+        print(f"Serving {len(server.RequestHandlerClass.pages)} pages on http://{args.host}:{server.server_port}")
+        server.serve_forever()
+        sys.exit(0)
+
+    from listing import load_listing
+    ids = args.thread_ids or sorted(load_listing(args.json_dir))
+    if args.save_dir is not None:
+        os.makedirs(args.save_dir, exist_ok=True)
+    page_fetcher = PageFetcher(args.base_url, args.concurrency, args.per_host, args.rate, args.retries,
+                               save_dir=args.save_dir)
+    json_dir = args.json_dir if os.path.isdir(args.json_dir) else None
+    print(refresh(ids, page_fetcher, args.workers, args.engine, json_dir, args.batch_size, args.db, args.db_profile))
@@ -0,0 +1,219 @@
+import os
+import re
+import sys
+import time
+import argparse
+
+
+FIELD_KEYS = ['overview', 'developer', 'platform', 'censorship', 'language']
+# Headings that introduce the overview. No key is a prefix of a key listed after it,
+# so the first match in this order is also the longest match.
+LINEKEYS = ["overview:", "overiew:", "- overview -", "-about-", "overview :", "* game overview", "<plot>",
+            "=about=", "about the game:", "about this game collection:", "about this game:", "about the site:",
+            "about:", "dev's intro:", "description:", "review:", "welcome:", "from the dev team:", "game info:",
+            "game guide:", "story overview: ", "synopsis:", "=speechoice", "synopsis", "description",
+            "story gameplay", "the story:", "about this game", "about the game", "basic plot", "plot:", "plot",
+            "about", "overview", "story:", "story -", "story"]
+LINEKEY_RE = re.compile('|'.join(re.escape(linekey) for linekey in sorted(LINEKEYS, key=len, reverse=True)))
+FIELD_RE = re.compile(r'(developer|platform|censorship|language):')
+
+
+class _Overview:
+    """Overview fragments collected in a list and joined once, instead of re-concatenating per line."""
+
+    def __init__(self):
+        self.parts = None
+        self.length = 0
+
+    def replace(self, fragment):
+        self.parts = [fragment]
+        self.length = len(fragment)
+
+    def append(self, fragment):
+        if self.parts is None:
+            self.replace('')
+        self.parts.append(fragment)
+        self.length += len(fragment) + 1
+
+    def extend(self, fragment):
+        """Appends to an overview longer than 3 characters, otherwise starts over."""
+        if self.parts is not None and self.length > 3:
+            self.append(fragment)
+        else:
+            self.replace(fragment)
+
+    def value(self):
+        return None if self.parts is None else ' '.join(self.parts)
+
+
+def extract_fields(text):
+    """
+    Scans the text of the first post line by line for the overview, developer, platform,
+    censorship and language fields. Shared by both parse engines.
+    """
+    fields = dict.fromkeys(FIELD_KEYS)
+    overview = _Overview()
+    state = 0
+    for chunk in text.split('\n'):
+        chunklow = chunk.lower().strip()
+        if state == 0:
+            match = LINEKEY_RE.match(chunklow)
+            if match is not None:
+                lklen = match.end() + 1
+                if len(chunklow) > lklen + 1:
+                    overview.extend(chunk[lklen:].strip())
+                    state = 2
+                else:
+                    state = 1
+                continue
+            match = FIELD_RE.match(chunklow)
+            if match is not None:
+                fields[match.group(1)] = chunk[match.end() + 1:].strip()
+        elif state == 1:
+            if 'developer:' in chunklow:
+                if chunklow.startswith('developer:'):
+                    fields['developer'] = chunk[11:].strip()
+                else:
+                    chunklowchunks = chunklow.split('developer:')
+                    fields['developer'] = chunklowchunks[-1]
+                    overview.append("developer: ".join(chunklowchunks[:-1]))
+                state = 0
+            else:
+                overview.replace(chunk.strip())
+                state = 2
+        else:
+            if len(chunk) > 5:
+                if 'developer:' in chunklow:
+                    if chunklow.startswith('developer:'):
+                        fields['developer'] = chunk[11:].strip()
+                    else:
+                        chunklowchunks = chunklow.split('developer: ')
+                        fields['developer'] = chunklowchunks[-1]
+                        overview.append("developer: ".join(chunklowchunks[:-1]))
+                else:
+                    overview.append(chunk.strip())
+            state = 0
+    fields['overview'] = overview.value()
+    return fields
+
+
+def reference_scan(text):
+    """The original line-by-line scan that extract_fields replaces, kept as the benchmark baseline."""
+    textchunks = text.split('\n')
+    overview = 0
+    lksem = 0
+    textkeys = FIELD_KEYS
+    linekeys = LINEKEYS
+    fields = dict()
+    for tk in textkeys:
+        fields[tk] = None
+    for chunk in textchunks:
+        chunklow = chunk.lower().strip()
+        if chunklow == '' or chunklow == ' ':
+            pass
+        if overview == 0:
+            for linekey in linekeys:
+                if chunklow.startswith(linekey):
+                    lklen = len(linekey) + 1
+                    if len(chunklow) > lklen + 1:
+                        if isinstance(fields['overview'], str) and len(fields['overview']) > 3:
+                            fields['overview'] = f"{fields['overview']} {chunk[lklen:].strip()}"
+                        else:
+                            fields['overview'] = chunk[lklen:].strip()
+                        overview = 2
+                        lksem = 1
+                        break
+                    else:
+                        overview = 1
+                        lksem = 1
+                        break
+        if lksem == 1:
+            lksem = 0
+            continue
+        if overview == 1:
+            if 'developer:' in chunklow:
+                if chunklow.startswith('developer:'):
+                    fields['developer'] = chunk[11:].strip()
+                    overview = 0
+                else:
+                    chunklowchunks = chunklow.split('developer:')
+                    fields['developer'] = chunklowchunks[-1]
+                    overviewaddition = "developer: ".join([chl for chl in chunklowchunks[:-1]])
+                    fields['overview'] = " ".join([fields['overview'], overviewaddition])
+                    overview = 0
+            else:
+                if isinstance(fields['overview'], str) and len(fields['overview']) > 3:
+                    fields['overview'] = f"{fields['overview']} {chunk.strip()}"
+                else:
+                    fields['overview'] = chunk.strip()
+                fields['overview'] = chunk.strip()
+                overview = 2
+        elif overview == 2:
+            if len(chunk) > 5:
+                if 'developer:' in chunklow:
+                    if chunklow.startswith('developer:'):
+                        fields['developer'] = chunk[11:].strip()
+                    else:
+                        chunklowchunks = chunklow.split('developer: ')
+                        fields['developer'] = chunklowchunks[-1]
+                        overviewaddition = "developer: ".join([chl for chl in chunklowchunks[:-1]])
+                        fields['overview'] = " ".join([fields['overview'], overviewaddition])
+                else:
+                    fields['overview'] = "{} {}".format(fields['overview'], chunk.strip())
+            overview = 0
+        elif chunklow.startswith('developer:'):
+            fields['developer'] = chunk[11:].strip()
+        elif chunklow.startswith('platform:'):
+            fields['platform'] = chunk[10:].strip()
+        elif chunklow.startswith('censorship:'):
+            fields['censorship'] = chunk[12:].strip()
+        elif chunklow.startswith('language:'):
+            fields['language'] = chunk[10:].strip()
+    return fields
+
+
+def load_bodies(download_dir):
+    """Returns the first-post text of every saved page in download_dir."""
+    from lxml import etree
+    from pageparse import LXML_PARSER, XP_MAINCONTENT, XP_MESSAGE, XP_BODY, _first, _text
+    bodies = list()
+    for root, dirs, files in os.walk(download_dir):
+        for file in files:
+            with open(os.path.join(root, file), 'r', encoding='UTF-8') as pagefile:
+                tree = etree.fromstring(pagefile.read(), LXML_PARSER)
+            maincontent = _first(XP_MAINCONTENT(tree))
+            mc = _first(XP_MESSAGE(maincontent)) if maincontent is not None else None
+            mc = _first(XP_BODY(mc)) if mc is not None else None
+            if mc is not None:
+                bodies.append(_text(mc))
+    return bodies
+
+
+def benchmark(bodies, repeat=5):
+    """Times extract_fields against reference_scan over the same bodies and checks they agree."""
+    mismatches = sum(1 for body in bodies if extract_fields(body) != reference_scan(body))
+    results = dict()
+    for name, scan in (('reference', reference_scan), ('extract_fields', extract_fields)):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for body in bodies:
+                scan(body)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+    lines = sum(body.count('\n') + 1 for body in bodies)
+    for name, best in results.items():
+        print(f"{name:<15} {best * 1000:.1f} ms for {len(bodies)} bodies ({lines} lines), "
+              f"{best / max(len(bodies), 1) * 1e6:.1f} us/body")
+    print(f"{mismatches} of {len(bodies)} bodies differ")
+    return results, mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmark the first-post field extractor.")
+    parser.add_argument('download_dir', help="directory of saved thread pages")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    results, mismatches = benchmark(load_bodies(args.download_dir), args.repeat)
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from f95_models import User, Tag, Image, Developer, Platform, Link, Language
+
+
+# Natural key column of every lookup table that insert_threads resolves.
+DIMENSION_KEYS = {
+    User: 'id',
+    Tag: 'name',
+    Developer: 'name',
+    Platform: 'name',
+    Language: 'name',
+    Link: 'url',
+    Image: 'url',
+}
+# Links and images grow with the catalogue, the other tables stay at a few hundred rows.
+LRU_LIMITS = {
+    Link: 200000,
+    Image: 200000,
+}
+
+
+class IdCache:
+    """Natural key -> primary key map for one table, optionally bounded as an LRU."""
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, keys):
+        """Splits keys into a dict of cached key -> id and a list of keys that missed."""
+        found = dict()
+        missing = list()
+        for key in keys:
+            try:
+                found[key] = self.ids[key]
+            except KeyError:
+                missing.append(key)
+                continue
+            if self.maxsize is not None:
+                self.ids.move_to_end(key)
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def update(self, idmap):
+        for key, row_id in idmap.items():
+            self.ids[key] = row_id
+            if self.maxsize is not None:
+                self.ids.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self.ids) > self.maxsize:
+                self.ids.popitem(last=False)
+
+    def clear(self):
+        self.ids.clear()
+
+
+class DimensionCache:
+    """
+    Process-wide cache of lookup table ids keyed by natural key (Tag.name, Link.url, User.id, ...).
+    Only committed rows should be added, otherwise a rolled back insert leaves dangling ids behind.
+    """
+
+    def __init__(self, limits=None):
+        limits = LRU_LIMITS if limits is None else limits
+        self.tables = {model: IdCache(limits.get(model)) for model in DIMENSION_KEYS}
+
+    def __getitem__(self, model):
+        return self.tables[model]
+
+    def warm(self, session):
+        """Loads the lookup tables; bounded tables only get their most recent rows."""
+        for model, keyname in DIMENSION_KEYS.items():
+            cache = self.tables[model]
+            query = session.query(getattr(model, keyname), model.id)
+            if cache.maxsize is not None:
+                rows = query.order_by(model.id.desc()).limit(cache.maxsize).all()
+                rows.reverse()
+            else:
+                rows = query.all()
+            cache.update(dict(rows))
+
+    def clear(self):
+        for cache in self.tables.values():
+            cache.clear()
+
+    def stats(self):
+        return {model.__tablename__: {'size': len(cache), 'hits': cache.hits, 'misses': cache.misses}
+                for model, cache in self.tables.items()}
+
+    def report(self):
+        lines = list()
+        for name, stat in self.stats().items():
+            lookups = stat['hits'] + stat['misses']
+            ratio = stat['hits'] / lookups if lookups else 0.0
+            lines.append(f"{name:<10} size={stat['size']:<8} hits={stat['hits']:<10} misses={stat['misses']:<10} "
+                         f"hit ratio={ratio:.1%}")
+        return "\n".join(lines)
@@ -0,0 +1,158 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class Histogram:
+    """Durations in power-of-two microsecond buckets, plus count, total, min and max."""
+    BUCKETS = 40
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        self.count += other['count']
+        self.total += other['total']
+        if other['min'] is not None and (self.min is None or other['min'] < self.min):
+            self.min = other['min']
+        self.max = max(self.max, other['max'])
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other['buckets'])]
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples, in seconds."""
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+                'buckets': list(self.buckets)}
+
+
+class Timings:
+    """
+    Per-stage timers for the ingest pipeline. Disabled by default, in which case stage() hands back
+    a shared no-op context manager and start()/lap() skip the clock entirely.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = dict()
+
+    def _histogram(self, name):
+        try:
+            return self.stages[name]
+        except KeyError:
+            histogram = self.stages[name] = Histogram()
+            return histogram
+
+    def add(self, name, seconds):
+        self._histogram(name).add(seconds)
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NOOP
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._histogram(name).add(time.perf_counter() - started)
+
+    def start(self):
+        return time.perf_counter() if self.enabled else None
+
+    def lap(self, name, started):
+        """Records the time since started under name and returns the new starting point."""
+        if started is None:
+            return None
+        now = time.perf_counter()
+        self._histogram(name).add(now - started)
+        return now
+
+    def drain(self):
+        """Returns the collected stages as plain dicts and resets them, for shipping out of a worker."""
+        stages = {name: histogram.to_dict() for name, histogram in self.stages.items()}
+        self.stages = dict()
+        return stages
+
+    def merge(self, stages):
+        for name, stage in stages.items():
+            self._histogram(name).merge(stage)
+
+    def report(self):
+        lines = [f"{'stage':<22}{'count':>9}{'total s':>11}{'mean ms':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}"
+                 f"{'max ms':>9}"]
+        for name in sorted(self.stages):
+            histogram = self.stages[name]
+            mean = histogram.total / histogram.count if histogram.count else 0.0
+            lines.append(f"{name:<22}{histogram.count:>9}{histogram.total:>11.2f}{mean * 1000:>10.3f}"
+                         f"{histogram.percentile(0.5) * 1000:>9.3f}{histogram.percentile(0.9) * 1000:>9.3f}"
+                         f"{histogram.percentile(0.99) * 1000:>9.3f}{histogram.max * 1000:>9.3f}")
+        return "\n".join(lines)
+
+    def export_json(self, path):
+        with open(path, 'w') as jfp:
+            json.dump({name: histogram.to_dict() for name, histogram in self.stages.items()}, jfp, indent=1)
+
+
+class _NoopStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopStage()
+timings = Timings()
+
+
+def profile_call(func, output=None, profiler='cprofile'):
+    """
+    Runs func() under cProfile (or pyinstrument when profiler='pyinstrument'), prints the hottest
+    functions and optionally writes the raw profile to output. Returns func's result.
+    """
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        prof = Profiler()
+        prof.start()
+        try:
+            result = func()
+        finally:
+            prof.stop()
+        print(prof.output_text(unicode=True))
+        if output is not None:
+            with open(output, 'w', encoding='UTF-8') as profile_file:
+                profile_file.write(prof.output_html())
+        return result
+    import cProfile
+    import pstats
+    prof = cProfile.Profile()
+    try:
+        result = prof.runcall(func)
+    finally:
+        pstats.Stats(prof).sort_stats('cumulative').print_stats(25)
+        if output is not None:
+            prof.dump_stats(output)
+    return result
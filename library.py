@@ -0,0 +1,303 @@
+import os
+import re
+import stat
+import time
+import argparse
+import unicodedata
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from f95_models import db_connect, create_tables, chunked, in_list, DEFAULT_DB_PATH
+
+
+ARCHIVE_EXTENSIONS = ('.zip', '.rar', '.7z', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.apk')
+BRACKETED = re.compile(r'\[[^\]]*\]|\([^)]*\)')
+NON_ALNUM = re.compile(r'[\W_]+')
+# Build suffixes engines add to folder and archive names, e.g. BeingADIK-0.8.0-pc.
+PLATFORM_SUFFIX = re.compile(r'[\s\-]+(?:pc|win|windows|win64|linux|mac|osx|market|android|x64|x86|all)\b', re.I)
+VERSION = re.compile(r'\bv(?:er(?:sion)?)?[\s.]*\d+(?:\.\d+)*[a-z]?\b|\b\d+(?:\.\d+)+[a-z]?\b'
+                     r'|\b(?:ep(?:isode)?|ch(?:apter)?|season)[\s.]*\d+(?:\.\d+)*\b|\bfinal\b', re.I)
+VERSION_PREFIX = re.compile(r'^(?:version|ver|v)[\s.]*(?=\d)')
+VERSION_WORDS = {'episode': 'ep', 'chapter': 'ch'}
+WORD_NUMBER = re.compile(r'([a-z])[\s.]*(?=\d)')
+DOTTED_NUMBERS = re.compile(r'\d+(?:\.\d+)*')
+# Lowest SequenceMatcher ratio a fuzzy title match may have.
+FUZZY_CUTOFF = 0.88
+SCAN_WORKERS = 16
+
+UPDATE_ROWS = '''
+    SELECT downloaded.path, downloaded.version, thread.id, thread.title, thread.version, downloaded.score
+    FROM downloaded JOIN thread ON thread.id = downloaded.thread_id
+    WHERE downloaded.version IS NOT NULL AND thread.version IS NOT NULL
+    AND version_key(downloaded.version) != version_key(thread.version)
+    AND NOT EXISTS (SELECT 1 FROM downloaded AS current WHERE current.thread_id = thread.id
+                    AND version_key(current.version) = version_key(thread.version))
+    ORDER BY thread.title, downloaded.path
+'''
+CANDIDATE_ROWS = '''
+    SELECT thread.title_key, thread.id, developer.name FROM thread
+    LEFT JOIN developer ON developer.id = thread.developer_id
+    WHERE thread.title_key IN ({keys})
+'''
+
+
+def _fold(value):
+    value = unicodedata.normalize('NFKD', value.casefold())
+    return NON_ALNUM.sub('', ''.join(char for char in value if not unicodedata.combining(char)))
+
+
+def title_key(title):
+    """Normalized title for matching: bracketed parts dropped, case and accents folded, only letters and digits."""
+    if title is None:
+        return None
+    return _fold(BRACKETED.sub(' ', title))
+
+
+def version_key(version):
+    """Normalized version for comparing: 'v0.8.2' = '0.8.2', 'Episode 3' = 'Ep. 3' = 'ep 3', '0_8' = '0.8'."""
+    if version is None:
+        return None
+    version = ' '.join(version.casefold().replace('_', '.').split())
+    version = VERSION_PREFIX.sub('', version)
+    for word, short in VERSION_WORDS.items():
+        version = version.replace(word, short)
+    return WORD_NUMBER.sub(r'\1 ', version)
+
+
+def version_numbers(version):
+    """A plain dotted version as a tuple of ints for ordering, e.g. 'v0.10.2' -> (0, 10, 2), else None."""
+    key = version_key(version)
+    if key is None or not DOTTED_NUMBERS.fullmatch(key):
+        return None
+    return tuple(int(part) for part in key.split('.'))
+
+
+def parse_entry_name(name):
+    """(title, version) from a game folder or archive name such as 'Being A DIK v0.8.2 [DrPinkCake]'."""
+    lowered = name.casefold()
+    for extension in ARCHIVE_EXTENSIONS:
+        if lowered.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    groups = BRACKETED.findall(name)
+    rest = PLATFORM_SUFFIX.sub('', BRACKETED.sub(' ', name).replace('_', ' '))
+    matches = list(VERSION.finditer(rest))
+    if matches:
+        title, version = rest[:matches[-1].start()], matches[-1].group()
+    else:
+        title, version = rest, None
+        for group in groups:
+            match = VERSION.search(group)
+            if match is not None:
+                version = match.group()
+                break
+    title = title.strip(' -.')
+    return title or name, version
+
+
+def list_entries(roots):
+    """Absolute paths of the game folders and archives directly inside the library roots."""
+    for root in roots:
+        with os.scandir(os.path.abspath(root)) as entries:
+            for entry in entries:
+                if entry.is_dir() or entry.name.casefold().endswith(ARCHIVE_EXTENSIONS):
+                    yield entry.path
+
+
+def entry_mtime(path):
+    """
+    Newest mtime (ns) of an entry and, for a folder, of its top-level files, which an update usually
+    replaces without touching the folder itself. None when the entry has disappeared.
+    """
+    try:
+        st = os.stat(path)
+        mtime = st.st_mtime_ns
+        if stat.S_ISDIR(st.st_mode):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # DirEntry caches its stat result, and on Windows scandir fills it without a syscall.
+                    mtime = max(mtime, entry.stat(follow_symlinks=False).st_mtime_ns)
+    except (FileNotFoundError, PermissionError):
+        return None
+    return mtime
+
+
+def scan(roots, workers=SCAN_WORKERS):
+    """Stats every library entry in a thread pool; returns {path: mtime}."""
+    paths = list(list_entries(roots))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return {path: mtime for path, mtime in zip(paths, pool.map(entry_mtime, paths)) if mtime is not None}
+
+
+def fill_title_keys(session):
+    """Computes Thread.title_key for threads written before the column existed."""
+    rows = session.execute(text("SELECT id, title FROM thread WHERE title_key IS NULL AND title IS NOT NULL"))
+    keys = [{'id': thread_id, 'title_key': title_key(title)} for thread_id, title in rows]
+    if keys:
+        session.execute(text("UPDATE thread SET title_key = :title_key WHERE id = :id"), keys)
+    return len(keys)
+
+
+def sync_library(session, roots, workers=SCAN_WORKERS):
+    """
+    Brings Downloaded in line with the library roots: new and changed entries (by mtime) are parsed
+    and upserted, vanished ones deleted, entries elsewhere left alone. Paths are stored absolute and
+    compared normcased, so however a root is spelled its rows keep their matches. Returns counts per outcome.
+    """
+    found = scan(roots, workers)
+    roots = {os.path.normcase(os.path.abspath(root)) for root in roots}
+    known = dict()
+    removed = list()
+    for download_id, path, mtime in session.execute(text("SELECT id, path, mtime FROM downloaded")):
+        key = os.path.normcase(os.path.abspath(path))
+        if os.path.dirname(key) not in roots:
+            continue
+        if key in known:
+            removed.append(download_id)
+        else:
+            known[key] = (download_id, path, mtime)
+    changed = list()
+    respelled = list()
+    for path, mtime in found.items():
+        download_id, stored, stored_mtime = known.get(os.path.normcase(path), (None, None, None))
+        if stored is not None and stored != path:
+            # Rows written before paths were stored absolute move over with their match.
+            respelled.append({'id': download_id, 'path': path})
+        if stored is not None and stored_mtime == mtime:
+            continue
+        title, version = parse_entry_name(os.path.basename(path))
+        changed.append({'path': path, 'version': version, 'title_key': title_key(title), 'mtime': mtime})
+    keys = {os.path.normcase(path) for path in found}
+    removed.extend(download_id for key, (download_id, path, mtime) in known.items() if key not in keys)
+    for chunk in chunked(removed):
+        placeholders, params = in_list(chunk)
+        session.execute(text(f"DELETE FROM downloaded WHERE id IN ({placeholders})"), params)
+    if respelled:
+        session.execute(text("UPDATE downloaded SET path = :path WHERE id = :id"), respelled)
+    if changed:
+        # A renamed title has to be matched again, a new version of the same title keeps its thread.
+        session.execute(text(
+            "INSERT INTO downloaded (path, version, title_key, mtime) VALUES (:path, :version, :title_key, :mtime) "
+            "ON CONFLICT (path) DO UPDATE SET version = excluded.version, mtime = excluded.mtime, "
+            "thread_id = CASE WHEN title_key IS excluded.title_key THEN thread_id END, "
+            "score = CASE WHEN title_key IS excluded.title_key THEN score END, title_key = excluded.title_key"),
+            changed)
+    matched, unmatched = match_downloads(session)
+    return {'entries': len(found), 'changed': len(changed), 'removed': len(removed), 'matched': matched,
+            'unmatched': unmatched}
+
+
+def _candidates(session, keys):
+    candidates = dict()
+    for chunk in chunked(keys):
+        placeholders, params = in_list(chunk, 'key')
+        for key, thread_id, developer in session.execute(text(CANDIDATE_ROWS.format(keys=placeholders)), params):
+            candidates.setdefault(key, list()).append((thread_id, developer))
+    return candidates
+
+
+def fuzzy_match(key, keys_by_length, cutoff=FUZZY_CUTOFF):
+    """
+    The closest thread title key to key as (key, ratio), or None below cutoff. Only keys whose length
+    allows the cutoff are compared, and SequenceMatcher's cheap upper bounds run before its ratio.
+    """
+    matcher = SequenceMatcher(autojunk=False)
+    matcher.set_seq2(key)
+    best = None
+    # ratio = 2 * matches / (len(a) + len(b)) <= 2 * min(len) / (len(a) + len(b))
+    shortest = int(len(key) * cutoff / (2 - cutoff))
+    longest = int(len(key) * (2 - cutoff) / cutoff) + 1
+    for length in range(shortest, longest + 1):
+        for candidate in keys_by_length.get(length, ()):
+            matcher.set_seq1(candidate)
+            if matcher.real_quick_ratio() < cutoff or matcher.quick_ratio() < cutoff:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= cutoff and (best is None or ratio > best[1]):
+                best = (candidate, ratio)
+    return best
+
+
+def _pick(candidates, path):
+    """Of the threads sharing a title, the one whose developer the entry name mentions, else the newest."""
+    name = _fold(os.path.basename(path))
+    named = [thread_id for thread_id, developer in candidates if developer and _fold(developer) in name]
+    return max(named or [thread_id for thread_id, developer in candidates])
+
+
+def match_downloads(session, cutoff=FUZZY_CUTOFF):
+    """
+    Links unmatched Downloaded rows to threads: by exact title key through the Thread.title_key
+    index first, then by fuzzy match against all title keys. Returns (matched, still unmatched).
+    """
+    fill_title_keys(session)
+    pending = session.execute(text("SELECT id, path, title_key FROM downloaded "
+                                   "WHERE thread_id IS NULL AND title_key IS NOT NULL AND title_key != ''")).fetchall()
+    if not pending:
+        return 0, 0
+    keys = {key for download_id, path, key in pending}
+    candidates = _candidates(session, keys)
+    fuzzy = dict()
+    missing = keys - set(candidates)
+    if missing:
+        keys_by_length = dict()
+        for key, in session.execute(text("SELECT DISTINCT title_key FROM thread WHERE title_key IS NOT NULL")):
+            keys_by_length.setdefault(len(key), list()).append(key)
+        for key in missing:
+            match = fuzzy_match(key, keys_by_length, cutoff)
+            if match is not None:
+                fuzzy[key] = match
+        candidates.update(_candidates(session, {match for match, ratio in fuzzy.values()}))
+    links = list()
+    for download_id, path, key in pending:
+        if key in fuzzy:
+            match, score = fuzzy[key]
+        else:
+            match, score = key, 1.0
+        if match in candidates:
+            links.append({'id': download_id, 'thread_id': _pick(candidates[match], path), 'score': score})
+    if links:
+        session.execute(text("UPDATE downloaded SET thread_id = :thread_id, score = :score WHERE id = :id"), links)
+    return len(links), len(pending) - len(links)
+
+
+def updates_available(session):
+    """
+    Library entries whose matched thread has moved on to another version, as (path, local version,
+    thread_id, title, thread version, match score). One query over the whole table; a thread is left
+    out when any copy of it in the library already has the current version. Of two plain dotted
+    versions only a newer thread version counts, so a local build ahead of the thread is not listed.
+    """
+    connection = session.connection().connection.driver_connection
+    connection.create_function('version_key', 1, version_key, deterministic=True)
+    updates = list()
+    for row in session.execute(text(UPDATE_ROWS)):
+        local, current = version_numbers(row[1]), version_numbers(row[4])
+        if local is None or current is None or current > local:
+            updates.append(row)
+    return updates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Match local game folders to threads and list available updates.")
+    parser.add_argument('roots', nargs='*', help="library directories holding one folder or archive per game")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--workers', type=int, default=SCAN_WORKERS, help="threads statting library entries")
+    parser.add_argument('--unmatched', action='store_true', help="also list the entries no thread matched")
+    args = parser.parse_args()
+    engine = db_connect(args.db)
+    create_tables(engine)
+    session = sessionmaker(bind=engine)()
+    if args.roots:
+        started = time.perf_counter()
+        counts = sync_library(session, args.roots, args.workers)
+        session.commit()
+        print(f"library synced in {time.perf_counter() - started:.2f}s", counts)
+    for path, local, thread_id, title, version, score in updates_available(session):
+        fuzzy = "" if score == 1.0 else f"  (title match {score:.2f})"
+        print(f"{title}: {local} -> {version}  {path}{fuzzy}")
+    if args.unmatched:
+        for path, in session.execute(text("SELECT path FROM downloaded WHERE thread_id IS NULL ORDER BY path")):
+            print("unmatched:", path)
+    session.close()
@@ -0,0 +1,134 @@
+import os
+import re
+import json
+
+
+def parse_prefixes(value):
+    """Prefix ids as a tuple of ints, from a list of ids or its text form ("[7, 18]" or "7,18")."""
+    if value is None:
+        return tuple()
+    if isinstance(value, str):
+        return tuple(int(number) for number in re.findall(r'\d+', value))
+    return tuple(int(number) for number in value)
+
+
+class ListingRecord:
+    """The listing fields main merges into a parsed thread, without the rest of the listing entry."""
+    __slots__ = ('title', 'developer', 'version', 'views', 'likes', 'prefixes', 'rating', 'image_cover')
+
+    def __init__(self, title, developer, version, views, likes, prefixes, rating, image_cover):
+        self.title = title
+        self.developer = developer
+        self.version = version
+        self.views = views
+        self.likes = likes
+        self.prefixes = prefixes
+        self.rating = rating
+        self.image_cover = image_cover
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(entry['title'], entry['developer'], entry['version'], entry['views'], entry['likes'],
+                   parse_prefixes(entry['prefixes']), entry['rating'], entry['images']['cover'])
+
+
+class _JSONStream:
+    """Just enough of an incremental JSON reader to walk down to one array and decode its items one by one."""
+
+    def __init__(self, fp, chunksize=1 << 16):
+        self.fp = fp
+        self.chunksize = chunksize
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self.fp.read(self.chunksize)
+        if not data:
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in listing JSON, found {found!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number that runs up to the end of the buffer may continue in the next chunk.
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f"Expected ',' or ']' in listing JSON, found {separator!r}")
+
+    def iter_path(self, path):
+        """Yields the items of the array found by following the object keys in path."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            if key == path[0]:
+                if len(path) == 1:
+                    yield from self.iter_array()
+                else:
+                    yield from self.iter_path(path[1:])
+            else:
+                self.value()
+            separator = self.peek()
+            self.pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError(f"Expected ',' or '}}' in listing JSON, found {separator!r}")
+
+
+def iter_listing_file(jpath):
+    """Yields the msg.data entries of one listing dump without loading the whole file."""
+    with open(jpath, 'r') as jfp:
+        yield from _JSONStream(jfp).iter_path(('msg', 'data'))
+
+
+def load_listing(jsondir):
+    """
+    Returns a dict of thread id -> ListingRecord for every listing dump in jsondir.
+    Later files win when a thread appears more than once.
+    """
+    listing = dict()
+    for jfile in os.listdir(jsondir):
+        for entry in iter_listing_file(os.path.join(jsondir, jfile)):
+            listing[entry['thread_id']] = ListingRecord.from_entry(entry)
+    return listing
@@ -0,0 +1,72 @@
+import os
+import hashlib
+from collections import namedtuple
+
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'size', 'mtime', 'hash', 'edited'])
+
+
+def content_hash(raw):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def file_state(fpath, st, raw):
+    """Manifest row for a file that was just read, edited is filled in once the page is parsed."""
+    return {'path': fpath, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'hash': content_hash(raw), 'edited': None}
+
+
+def stat_unchanged(entry, fpath, st):
+    return entry is not None and entry.path == fpath and entry.size == st.st_size and entry.mtime == st.st_mtime_ns
+
+
+def load_manifest(session):
+    """Returns a dict of thread id -> ManifestEntry."""
+    # The database side is imported here, parse workers only need the file helpers of this module.
+    from f95_models import Manifest
+    manifest = dict()
+    for row in session.query(Manifest.thread_id, Manifest.path, Manifest.size, Manifest.mtime, Manifest.hash,
+                             Manifest.edited):
+        manifest[row[0]] = ManifestEntry(*row[1:])
+    return manifest
+
+
+def update_manifest(session, rows):
+    """rows are dicts with thread_id plus the file_state keys. HTTP validators are left alone."""
+    from sqlalchemy import text
+    if rows:
+        session.execute(text(
+            "INSERT INTO manifest (thread_id, path, size, mtime, hash, edited) "
+            "VALUES (:thread_id, :path, :size, :mtime, :hash, :edited) "
+            "ON CONFLICT (thread_id) DO UPDATE SET path = excluded.path, size = excluded.size, "
+            "mtime = excluded.mtime, hash = excluded.hash, edited = excluded.edited"), rows)
+
+
+def load_validators(session):
+    """Returns a dict of thread id -> (etag, last_modified) for conditional page fetches."""
+    from f95_models import Manifest
+    return {thread_id: (etag, last_modified) for thread_id, etag, last_modified in
+            session.query(Manifest.thread_id, Manifest.etag, Manifest.last_modified)
+            if etag is not None or last_modified is not None}
+
+
+def update_validators(session, rows):
+    """rows are dicts with thread_id, etag and last_modified."""
+    from sqlalchemy import text
+    if rows:
+        session.execute(text(
+            "INSERT INTO manifest (thread_id, etag, last_modified) VALUES (:thread_id, :etag, :last_modified) "
+            "ON CONFLICT (thread_id) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified"),
+            rows)
+
+
+def decode_page(raw):
+    """Page bytes to text, with newlines translated like a text-mode open()."""
+    return raw.decode('UTF-8').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def read_page(fpath):
+    """Reads a saved page as bytes and text."""
+    with open(fpath, 'rb') as pagefile:
+        st = os.fstat(pagefile.fileno())
+        raw = pagefile.read()
+    return st, raw, decode_page(raw)
@@ -0,0 +1,335 @@
+import os
+import mmap
+import time
+import random
+import struct
+import argparse
+from collections import namedtuple
+import zstandard
+from manifest import decode_page
+
+
+ARCHIVE_SUFFIX = '.zpk'
+MAGIC = b'F95PAGES'
+VERSION = 1
+# File header: magic, version, dictionary length, then the dictionary itself.
+HEADER = struct.Struct('<8sII')
+# Before every compressed page: thread id, compressed length, page size, source mtime in ns.
+RECORD = struct.Struct('<qIIq')
+# One index entry per appended page: thread id, offset of the compressed page, its length, page size, mtime.
+INDEX = struct.Struct('<qqIIq')
+DICT_SIZE = 112640
+DICT_SAMPLES = 2000
+DICT_MIN_SAMPLES = 8
+LEVEL = 9
+
+IndexEntry = namedtuple('IndexEntry', ['offset', 'length', 'size', 'mtime'])
+ArchivedStat = namedtuple('ArchivedStat', ['st_size', 'st_mtime_ns'])
+
+
+def is_archive(path):
+    return path.endswith(ARCHIVE_SUFFIX)
+
+
+def thread_id_from_filename(filename):
+    """Saved pages are named like 'thread-12345.html'."""
+    return int(filename.split('.')[0].split('-')[1])
+
+
+def train_dictionary(samples, dict_size=DICT_SIZE):
+    """
+    Trains a zstd dictionary on a list of page bytes, mostly capturing the shared forum boilerplate.
+    zstd cannot train on only a handful of pages; those archives get an empty dictionary, i.e. none.
+    """
+    if len(samples) < DICT_MIN_SAMPLES:
+        return b''
+    try:
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    except zstandard.ZstdError:
+        return b''
+
+
+class PageArchive:
+    """
+    An append-only file of zstd-compressed thread pages sharing one trained dictionary, plus an
+    id -> offset index in a sidecar '.idx' file. Reads go through mmap; a page appended again for
+    the same thread id supersedes the older copy until the archive is compacted. Only a writable
+    archive (or a new one) may be appended to and repairs the tail a crashed writer left behind;
+    readers never modify the files and skip an incomplete trailing record.
+    """
+
+    def __init__(self, path, dictionary=None, level=LEVEL, writable=False):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.level = level
+        self.writable = writable
+        self.entries = dict()
+        self.map = None
+        if not os.path.exists(path):
+            if dictionary is None:
+                raise FileNotFoundError(f"No page archive at {path}, and no dictionary to create one")
+            self.writable = True
+            with open(path, 'wb') as datafile:
+                datafile.write(HEADER.pack(MAGIC, VERSION, len(dictionary)) + dictionary)
+            open(self.index_path, 'wb').close()
+        with open(path, 'rb') as datafile:
+            magic, version, dict_length = HEADER.unpack(datafile.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a version {VERSION} page archive")
+            self.dictionary = datafile.read(dict_length)
+        self.data_start = HEADER.size + len(self.dictionary)
+        zdict = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=zdict)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+        self._load_index()
+
+    def _load_index(self):
+        end = self.data_start
+        try:
+            with open(self.index_path, 'rb') as indexfile:
+                data = indexfile.read()
+        except FileNotFoundError:
+            data = b''
+        # A torn trailing entry is dropped and recovered from the data file below.
+        valid = len(data) - len(data) % INDEX.size
+        for thread_id, offset, length, size, mtime in INDEX.iter_unpack(data[:valid]):
+            self.entries[thread_id] = IndexEntry(offset, length, size, mtime)
+            end = max(end, offset + length)
+        if valid != len(data) and self.writable:
+            with open(self.index_path, 'r+b') as indexfile:
+                indexfile.truncate(valid)
+        self._recover(end)
+
+    def _recover(self, end):
+        """
+        Indexes pages that made it into the data file but not into the index, e.g. after a crash or
+        while a writer is appending. Only a writable archive truncates a torn record and saves the entries.
+        """
+        recovered = list()
+        with open(self.path, 'r+b' if self.writable else 'rb') as datafile:
+            datafile.seek(0, os.SEEK_END)
+            filesize = datafile.tell()
+            datafile.seek(end)
+            while end + RECORD.size <= filesize:
+                thread_id, length, size, mtime = RECORD.unpack(datafile.read(RECORD.size))
+                if end + RECORD.size + length > filesize:
+                    break
+                recovered.append((thread_id, end + RECORD.size, length, size, mtime))
+                datafile.seek(length, os.SEEK_CUR)
+                end += RECORD.size + length
+            if end < filesize and self.writable:
+                datafile.truncate(end)
+        if recovered and self.writable:
+            with open(self.index_path, 'ab') as indexfile:
+                indexfile.write(b''.join(INDEX.pack(*entry) for entry in recovered))
+        for thread_id, offset, length, size, mtime in recovered:
+            self.entries[thread_id] = IndexEntry(offset, length, size, mtime)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, thread_id):
+        return thread_id in self.entries
+
+    def thread_ids(self):
+        """Thread ids in file order, which is the fastest order to read them in."""
+        return sorted(self.entries, key=lambda thread_id: self.entries[thread_id].offset)
+
+    def stat(self, thread_id):
+        entry = self.entries[thread_id]
+        return ArchivedStat(entry.size, entry.mtime)
+
+    def append(self, thread_id, raw, mtime=None):
+        self.append_many([(thread_id, raw, mtime)])
+
+    def append_many(self, pages):
+        """Appends (thread_id, page bytes, mtime in ns or None) pages with a single write to each file."""
+        if not self.writable:
+            raise ValueError(f"{self.path} is open for reading only")
+        records = list()
+        entries = list()
+        with open(self.path, 'ab') as datafile:
+            offset = datafile.tell()
+            for thread_id, raw, mtime in pages:
+                mtime = time.time_ns() if mtime is None else mtime
+                frame = self.compressor.compress(raw)
+                records.append(RECORD.pack(thread_id, len(frame), len(raw), mtime))
+                records.append(frame)
+                offset += RECORD.size
+                entries.append((thread_id, offset, len(frame), len(raw), mtime))
+                offset += len(frame)
+            datafile.write(b''.join(records))
+        with open(self.index_path, 'ab') as indexfile:
+            indexfile.write(b''.join(INDEX.pack(*entry) for entry in entries))
+        for thread_id, offset, length, size, mtime in entries:
+            self.entries[thread_id] = IndexEntry(offset, length, size, mtime)
+
+    def _frame(self, entry):
+        if self.map is None or entry.offset + entry.length > len(self.map):
+            self.close()
+            with open(self.path, 'rb') as datafile:
+                self.map = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[entry.offset:entry.offset + entry.length]
+
+    def read(self, thread_id):
+        """The page bytes of a thread; KeyError if it is not archived."""
+        entry = self.entries[thread_id]
+        return self.decompressor.decompress(self._frame(entry), max_output_size=entry.size)
+
+    def read_page(self, thread_id):
+        """Same result as manifest.read_page for a loose file: (stat, bytes, text)."""
+        raw = self.read(thread_id)
+        return self.stat(thread_id), raw, decode_page(raw)
+
+    def iter_raw(self):
+        """Yields (thread_id, page bytes) for the live copy of every page, in file order."""
+        for thread_id in self.thread_ids():
+            yield thread_id, self.read(thread_id)
+
+    def iter_pages(self):
+        """Yields (thread_id, page text), ready for parse_html(thread_id, archive.path, text)."""
+        for thread_id, raw in self.iter_raw():
+            yield thread_id, decode_page(raw)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+_open_archives = dict()
+
+
+def open_archive(path):
+    """A per-process shared PageArchive for reading, so pool workers map each archive once."""
+    try:
+        return _open_archives[path]
+    except KeyError:
+        archive = _open_archives[path] = PageArchive(path)
+        return archive
+
+
+def read_archived(path, thread_id):
+    """read_page for a page inside an archive; FileNotFoundError if the thread is not in it."""
+    try:
+        return open_archive(path).read_page(thread_id)
+    except KeyError:
+        raise FileNotFoundError(f"Thread {thread_id} is not in {path}") from None
+
+
+def _sample(paths, count=DICT_SAMPLES):
+    chosen = random.Random(0).sample(paths, min(count, len(paths)))
+    samples = list()
+    for fpath in chosen:
+        with open(fpath, 'rb') as pagefile:
+            samples.append(pagefile.read())
+    return samples
+
+
+def import_directory(path, download_dir, level=LEVEL, batch_size=200):
+    """
+    Adds every saved page in download_dir to the archive at path, creating it (and training its
+    dictionary on a sample of the pages) if needed. Pages whose size and mtime match the archived
+    copy are skipped. Returns (added, skipped).
+    """
+    pages = list()
+    for file in os.listdir(download_dir):
+        try:
+            pages.append((thread_id_from_filename(file), os.path.join(download_dir, file)))
+        except (IndexError, ValueError):
+            print("Not a thread page:", file)
+    if os.path.exists(path):
+        archive = PageArchive(path, level=level, writable=True)
+    else:
+        archive = PageArchive(path, train_dictionary(_sample([fpath for thread_id, fpath in pages])), level)
+    added = skipped = 0
+    batch = list()
+    for thread_id, fpath in sorted(pages):
+        st = os.stat(fpath)
+        if thread_id in archive and archive.stat(thread_id) == (st.st_size, st.st_mtime_ns):
+            skipped += 1
+            continue
+        with open(fpath, 'rb') as pagefile:
+            batch.append((thread_id, pagefile.read(), st.st_mtime_ns))
+        if len(batch) >= batch_size:
+            archive.append_many(batch)
+            added += len(batch)
+            batch = list()
+    if batch:
+        archive.append_many(batch)
+        added += len(batch)
+    archive.close()
+    return added, skipped
+
+
+def compact(path, retrain=False, level=LEVEL):
+    """
+    Rewrites the archive with only the live copy of each page, in thread id order. Compressed pages
+    are copied as they are unless retrain is set, which trains a fresh dictionary on the current pages.
+    """
+    archive = PageArchive(path, level=level, writable=True)
+    thread_ids = sorted(archive.entries)
+    if retrain:
+        dictionary = train_dictionary([archive.read(thread_id) for thread_id in
+                                       random.Random(0).sample(thread_ids, min(DICT_SAMPLES, len(thread_ids)))])
+    else:
+        dictionary = archive.dictionary
+    tmp_path = path + '.tmp'
+    for leftover in (tmp_path, tmp_path + '.idx'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    compacted = PageArchive(tmp_path, dictionary, level)
+    if retrain:
+        for i in range(0, len(thread_ids), 200):
+            compacted.append_many([(thread_id, archive.read(thread_id), archive.entries[thread_id].mtime)
+                                   for thread_id in thread_ids[i:i + 200]])
+    else:
+        with open(tmp_path, 'ab') as datafile, open(tmp_path + '.idx', 'ab') as indexfile:
+            offset = datafile.tell()
+            for thread_id in thread_ids:
+                entry = archive.entries[thread_id]
+                datafile.write(RECORD.pack(thread_id, entry.length, entry.size, entry.mtime))
+                datafile.write(archive._frame(entry))
+                offset += RECORD.size
+                indexfile.write(INDEX.pack(thread_id, offset, entry.length, entry.size, entry.mtime))
+                offset += entry.length
+    before = os.path.getsize(path)
+    archive.close()
+    compacted.close()
+    os.replace(tmp_path + '.idx', path + '.idx')
+    os.replace(tmp_path, path)
+    _open_archives.pop(path, None)
+    return before, os.path.getsize(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build and maintain a compressed archive of saved thread pages.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    importer = subparsers.add_parser('import', help="add the pages of a directory to the archive")
+    importer.add_argument('archive')
+    importer.add_argument('directory')
+    importer.add_argument('--level', type=int, default=LEVEL, help="zstd compression level")
+    compactor = subparsers.add_parser('compact', help="drop superseded pages from the archive")
+    compactor.add_argument('archive')
+    compactor.add_argument('--retrain', action='store_true', help="train a new dictionary on the current pages")
+    compactor.add_argument('--level', type=int, default=LEVEL)
+    info = subparsers.add_parser('info', help="print page count and sizes")
+    info.add_argument('archive')
+    extract = subparsers.add_parser('cat', help="print the HTML of one thread")
+    extract.add_argument('archive')
+    extract.add_argument('thread_id', type=int)
+    args = parser.parse_args()
+    if args.command == 'import':
+        added, skipped = import_directory(args.archive, args.directory, args.level)
+        print(f"{added} pages added, {skipped} unchanged")
+    elif args.command == 'compact':
+        before, after = compact(args.archive, args.retrain, args.level)
+        print(f"{before / 1e6:.1f} MB -> {after / 1e6:.1f} MB")
+    elif args.command == 'info':
+        pages = PageArchive(args.archive)
+        raw = sum(entry.size for entry in pages.entries.values())
+        size = os.path.getsize(args.archive)
+        print(f"{len(pages)} pages, {raw / 1e6:.1f} MB of HTML in {size / 1e6:.1f} MB "
+              f"({raw / max(size, 1):.1f}x), dictionary {len(pages.dictionary) / 1e3:.0f} kB")
+    else:
+        print(PageArchive(args.archive).read_page(args.thread_id)[2])
@@ -1,27 +1,63 @@
 import os
-from bs4 import BeautifulSoup, NavigableString
-import json
-from tqdm import tqdm
-from f95_models import db_connect, create_tables, User, Tag, Image, Developer, Platform, Link, Language, Thread, \
-    ThreadImage, ThreadLink, ThreadTag
+import sys
+import time
+import argparse
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+from lxml import etree
+from fieldextract import extract_fields
+from instrument import timings
+from records import ThreadRecord
+from pagearchive import is_archive, read_archived
+from manifest import file_state, read_page
 from contextlib import contextmanager
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
 
 
-engine = db_connect()
-create_tables(engine)
-DBSession = sessionmaker(bind=engine)
+# SQLAlchemy and the models, BeautifulSoup and tqdm are imported where they are used, so pool workers and
+# tools that only parse pages start without them. The database is opened by init_db, at the latest by
+# the first session_scope.
+engine = None
+DBSession = None
+id_cache = None
+LXML_PARSER = etree.HTMLParser()
+# Parse tasks a pool may have in flight or finished but not yet consumed, and the most sent in one call.
+PARSE_WINDOW = 64
+PARSE_CHUNK = 16
+
+
+def init_db(path=None, profile='default'):
+    """
+    Points the session factory at the database at path (default f95.db3), opened with the given SQLite
+    profile, and creates the tables it is missing.
+    """
+    global engine, DBSession, id_cache
+    from sqlalchemy.orm import sessionmaker
+    from f95_models import db_connect, create_tables, seed_prefixes, DEFAULT_DB_PATH
+    from idcache import DimensionCache
+    from search import create_search_index
+    if engine is not None:
+        engine.dispose()
+    engine = db_connect(DEFAULT_DB_PATH if path is None else path, profile)
+    create_tables(engine, indexes=profile != 'bulk')
+    seed_prefixes(engine)
+    create_search_index(engine)
+    DBSession = sessionmaker(bind=engine)
+    id_cache = DimensionCache()
+    return engine
 
 
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
+    if DBSession is None:
+        init_db()
     session = DBSession()
     session.expire_on_commit = False
     try:
         yield session
-        session.commit()
+        with timings.stage('commit'):
+            session.commit()
     except:
         session.rollback()
         raise
@@ -30,9 +66,12 @@ def session_scope():
 
 
 def parse_html(thread_id, fpath, rawhtml):
+    from bs4 import BeautifulSoup, NavigableString
     infodict = dict()
 
+    started = timings.start()
     soup = BeautifulSoup(rawhtml, "lxml")
+    started = timings.lap('parse_tree', started)
     if soup.title.head == 'Google':
         return None
     # divs = rl.find_all('div')
@@ -61,7 +100,7 @@ def parse_html(thread_id, fpath, rawhtml):
         maincontent = soup.select_one('div[uix_component="MainContent"]')
     except IndexError:
         print('Broken File:', fpath)
-        return infodict
+        return ThreadRecord.from_infodict(infodict)
 
     try:
         infodict['title'] = str(maincontent.select_one('h1[class="p-title-value"]').contents[-1]).strip()
@@ -135,80 +174,9 @@ def parse_html(thread_id, fpath, rawhtml):
             continue
         mcitems.append(mcitem)
     """
-    textchunks = mc.text.split('\n')
-    overview = 0
-    lksem = 0
-    textkeys = ['overview', 'developer', 'platform', 'censorship', 'language']
-    linekeys = ["overview:", "overiew:", "- overview -", "-about-", "overview :", "* game overview", "<plot>",
-                "=about=", "about the game:", "about this game collection:", "about this game:", "about the site:",
-                "about:", "dev's intro:", "description:", "review:", "welcome:", "from the dev team:", "game info:",
-                "game guide:", "story overview: ", "synopsis:", "=speechoice", "synopsis", "description",
-                "story gameplay", "the story:", "about this game", "about the game", "basic plot", "plot:", "plot",
-                "about", "overview", "story:", "story -", "story"]
-    for tk in textkeys:
-        infodict[tk] = None
-    for chunk in textchunks:
-        chunklow = chunk.lower().strip()
-        if chunklow == '' or chunklow == ' ':
-            pass
-        if overview == 0:
-            for linekey in linekeys:
-                if chunklow.startswith(linekey):
-                    lklen = len(linekey) + 1
-                    if len(chunklow) > lklen + 1:
-                        if isinstance(infodict['overview'], str) and len(infodict['overview']) > 3:
-                            infodict['overview'] = f"{infodict['overview']} {chunk[lklen:].strip()}"
-                        else:
-                            infodict['overview'] = chunk[lklen:].strip()
-                        overview = 2
-                        lksem = 1
-                        break
-                    else:
-                        overview = 1
-                        lksem = 1
-                        break
-        if lksem == 1:
-            lksem = 0
-            continue
-        if overview == 1:
-            if 'developer:' in chunklow:
-                if chunklow.startswith('developer:'):
-                    infodict['developer'] = chunk[11:].strip()
-                    overview = 0
-                else:
-                    chunklowchunks = chunklow.split('developer:')
-                    infodict['developer'] = chunklowchunks[-1]
-                    overviewaddition = "developer: ".join([chl for chl in chunklowchunks[:-1]])
-                    infodict['overview'] = " ".join([infodict['overview'], overviewaddition])
-                    overview = 0
-            else:
-                if isinstance(infodict['overview'], str) and len(infodict['overview']) > 3:
-                    infodict['overview'] = f"{infodict['overview']} {chunk.strip()}"
-                else:
-                    infodict['overview'] = chunk.strip()
-                infodict['overview'] = chunk.strip()
-                overview = 2
-        elif overview == 2:
-            if len(chunk) > 5:
-                if 'developer:' in chunklow:
-                    if chunklow.startswith('developer:'):
-                        infodict['developer'] = chunk[11:].strip()
-                    else:
-                        chunklowchunks = chunklow.split('developer: ')
-                        infodict['developer'] = chunklowchunks[-1]
-                        overviewaddition = "developer: ".join([chl for chl in chunklowchunks[:-1]])
-                        infodict['overview'] = " ".join([infodict['overview'], overviewaddition])
-                else:
-                    infodict['overview'] = "{} {}".format(infodict['overview'], chunk.strip())
-            overview = 0
-        elif chunklow.startswith('developer:'):
-            infodict['developer'] = chunk[11:].strip()
-        elif chunklow.startswith('platform:'):
-            infodict['platform'] = chunk[10:].strip()
-        elif chunklow.startswith('censorship:'):
-            infodict['censorship'] = chunk[12:].strip()
-        elif chunklow.startswith('language:'):
-            infodict['language'] = chunk[10:].strip()
+    text = mc.text
+    with timings.stage('extract.overview_scan'):
+        infodict.update(extract_fields(text))
 
     imagelinks = set()
     if infodict['overview'] is None or infodict['overview'] == '' or len(infodict['overview']) < 10:
@@ -254,168 +222,484 @@ def parse_html(thread_id, fpath, rawhtml):
     except IndexError:
         pass
 
-    return infodict
+    timings.lap('extract', started)
+    return ThreadRecord.from_infodict(infodict)
 
 
-def insert_thread(infodict):
-    user_name = infodict.pop('user_name')
-    user_url = infodict.pop('user_url')
-    user_id = infodict.pop('user_id')
-    tags = infodict.pop('tags')
-    links = infodict.pop('downloadlinks')
-    images = infodict.pop('images')
-    developer = infodict.pop('developer')
-    platform = infodict.pop('platform')
-    language = infodict.pop('language')
+# Precompiled XPath expressions for parse_html_lxml, each mirroring one BeautifulSoup lookup in parse_html.
+XP_CANONICAL = etree.XPath('(//link[@rel="canonical"])[1]/@href')
+XP_TITLE = etree.XPath('((//head)[1]//title)[1]')
+XP_MAINCONTENT = etree.XPath('(//div[@uix_component="MainContent"])[1]')
+XP_H1_NODES = etree.XPath('(.//h1[@class="p-title-value"])[1]/node()')
+XP_VOTES = etree.XPath('((((.//div[@class="tabs tabs--standalone"])[1]//div)[1]//span)[1]//a)[2]')
+XP_PAGES = etree.XPath('((((.//div[@class="inputGroup inputGroup--numbers"])[1]//div)[1]//input)[1])/@max')
+XP_USER = etree.XPath('(//a[starts-with(@class, "username")])[1]')
+XP_TAGS = etree.XPath('(.//li[@class="groupedTags"])[1]//a')
+XP_RATING = etree.XPath('(.//select[@name="rating"])[1]/@data-initial-rating')
+XP_DATE = etree.XPath('(.//time[@class="u-dt"])[1]/@data-time')
+XP_MESSAGE = etree.XPath('(.//div[@class="message-content js-messageContent"])[1]')
+XP_EDITED = etree.XPath('(((.//div[starts-with(@class, "message-lastEdit")])[1]//time)[1])/@data-time')
+XP_BODY = etree.XPath('(.//article[@class="message-body js-selectToQuote"])[1]')
+# BeautifulSoup's .text leaves out comments and script/style/template contents.
+XP_TEXT = etree.XPath('.//text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+XP_NOSCRIPT = etree.XPath('(.//noscript)[1]')
+XP_FOLLOWING = etree.XPath('following::node()')
+XP_IMAGES = etree.XPath('.//a[@class="js-lbImage"]')
+XP_IMAGE_ALT = etree.XPath('(.//img)[1]/@alt')
+XP_DOWNLOAD_SPAN = etree.XPath('(.//span[@style="font-size: 18px"])[1]')
+XP_ANCHORS = etree.XPath('.//a')
+XP_EXTERNAL_LINKS = etree.XPath('.//a[@class="link link--external"]')
 
-    with session_scope() as session:
-        try:
-            user = session.query(User).filter(User.id == user_id).one()
-            infodict['user_id'] = user.id
-        except NoResultFound:
-            user = User(id=user_id, name=user_name, url=user_url)
-            session.add(user)
-            session.flush()
-            infodict['user_id'] = user.id
-        tagidlist = list()
-        for tag_name, tag_url in tags.items():
-            try:
-                tag = session.query(Tag).filter(Tag.name == tag_name).one()
-                tagidlist.append(tag.id)
-            except NoResultFound:
-                tag = Tag(name=tag_name, url=tag_url)
-                session.add(tag)
-                session.flush()
-                tagidlist.append(tag.id)
-        linkidlist = list()
-        for link in links:
-            try:
-                link = session.query(Link).filter(Link.url == link).one()
-                linkidlist.append(link.id)
-            except NoResultFound:
-                link = Link(url=link)
-                session.add(link)
-                session.flush()
-                linkidlist.append(link.id)
-        imageidlist = list()
-        for image_name, image_url in images:
-            try:
-                image = session.query(Image).filter(Image.url == image_url).one()
-                imageidlist.append(image.id)
-            except NoResultFound:
-                image = Image(name=image_name, url=image_url)
-                session.add(image)
-                session.flush()
-                imageidlist.append(image.id)
-        try:
-            developer = session.query(Developer).filter(Developer.name == developer).one()
-            infodict['developer_id'] = developer.id
-        except NoResultFound:
-            developer = Developer(name=developer)
-            session.add(developer)
-            session.flush()
-            infodict['developer_id'] = developer.id
-        try:
-            platform = session.query(Platform).filter(Platform.name == platform).one()
-            infodict['platform_id'] = platform.id
-        except NoResultFound:
-            platform = Platform(name=platform)
-            session.add(platform)
-            session.flush()
-            infodict['platform_id'] = platform.id
+
+def _first(results):
+    if not results:
+        return None
+    # XPath string results keep their whole tree alive, so hand back plain str.
+    return str(results[0]) if isinstance(results[0], str) else results[0]
+
+
+def _text(element):
+    return ''.join(XP_TEXT(element))
+
+
+def parse_html_lxml(thread_id, fpath, rawhtml):
+    """
+    Same fields as parse_html, read with precompiled XPath expressions straight off the lxml tree
+    instead of building a BeautifulSoup tree and matching CSS selectors against it.
+    """
+    infodict = dict()
+
+    started = timings.start()
+    root = etree.fromstring(rawhtml, LXML_PARSER)
+    started = timings.lap('parse_tree', started)
+    canonical = _first(XP_CANONICAL(root))
+    if canonical is None:
+        print("AttributeError, canonical:", fpath)
+    infodict['canonical'] = canonical
+    title = _first(XP_TITLE(root))
+    infodict['title'] = _text(title) if title is not None else None
+    infodict['id'] = thread_id
+    infodict['details'] = None
+    infodict['user_id'] = None
+    infodict['user_name'] = None
+    infodict['user_url'] = None
+    infodict['mainimage'] = None
+    infodict['pages'] = None
+    infodict['votes'] = None
+    infodict['images'] = list()
+    infodict['links'] = list()
+    infodict['tags'] = list()
+    maincontent = _first(XP_MAINCONTENT(root))
+    if maincontent is None:
+        print('Broken File:', fpath)
+        return ThreadRecord.from_infodict(infodict)
+
+    h1nodes = XP_H1_NODES(maincontent)
+    if h1nodes:
+        last = h1nodes[-1]
+        if isinstance(last, str):
+            infodict['title'] = str(last).strip()
+        else:
+            infodict['title'] = etree.tostring(last, method='html', encoding='unicode', with_tail=False).strip()
+    vote = _first(XP_VOTES(maincontent))
+    if vote is not None:
         try:
-            language = session.query(Language).filter(Language.name == language).one()
-            infodict['language_id'] = language.id
-        except NoResultFound:
-            language = Language(name=language)
-            session.add(language)
-            session.flush()
-            infodict['language_id'] = language.id
+            infodict['votes'] = int(_text(vote)[9:-1])
+        except ValueError:
+            pass
+    try:
+        infodict['pages'] = int(_first(XP_PAGES(maincontent)))
+    except (TypeError, ValueError):
+        pass
+    userchunk = _first(XP_USER(root))
+    if userchunk is not None:
         try:
-            thread = session.query(Thread).filter(Thread.id == infodict['id']).one()
-            # if infodict['name'] != '' and thread.name != infodict['name']:
-            #     thread.name = infodict['name']
-            thread.edited = infodict['edited']
-            thread.views = infodict['views']
-            thread.votes = infodict['votes']
-            thread.likes = infodict['likes']
-            thread.pages = infodict['pages']
-            thread.version = infodict['version']
-            thread.rating = infodict['rating']
-            session.flush()
-            thread_id = thread.id
-        except NoResultFound:
-            thread = Thread(**infodict)
-            session.add(thread)
-            session.flush()
-            thread_id = thread.id
-        for tag_id in tagidlist:
-            try:
-                session.query(ThreadTag).filter(ThreadTag.tag_id == tag_id,
-                                                ThreadTag.thread_id == thread_id).one()
-            except NoResultFound:
-                tag_id = ThreadTag(tag_id=tag_id, thread_id=thread_id)
-                session.add(tag_id)
-                session.flush()
-        for link_id in linkidlist:
-            try:
-                session.query(ThreadLink).filter(ThreadLink.link_id == link_id,
-                                                 ThreadLink.thread_id == thread_id).one()
-            except NoResultFound:
-                link_id = ThreadLink(link_id=link_id, thread_id=thread_id)
-                session.add(link_id)
-                session.flush()
-        for image_id in imageidlist:
-            try:
-                session.query(ThreadImage).filter(ThreadImage.image_id == image_id,
-                                                  ThreadImage.thread_id == thread_id).one()
-            except NoResultFound:
-                image_id = ThreadImage(image_id=image_id, thread_id=thread_id)
-                session.add(image_id)
-                session.flush()
-        session.commit()
-
-
-def main():
-    jsondict = dict()
-    jsondir = os.path.join(os.getcwd(), "JSON")
-    for jfile in os.listdir(jsondir):
-        jpath = os.path.join(jsondir, jfile)
-        with open(jpath, 'r') as jfp:
-            jfile = json.load(jfp)
-            jdata = jfile['msg']['data']
-            for thread in jdata:
-                thread_id = thread['thread_id']
-                jsondict[thread_id] = thread
-    download_dir = r"D:\dazpages\f95"
-    # fset = set()
-    for root, dirs, files in os.walk(download_dir):
-        for file in tqdm(files):
-            try:
-                thread_id = int(file.split('.')[0].split('-')[1])
-            except (IndexError, TypeError):
-                print("Type Error for", file)
-                continue
-            fpath = os.path.join(r"D:\dazpages\f95", file)
-            try:
-                with open(fpath, 'r', encoding='UTF-8') as tempfile:
-                    rawhtml = tempfile.read()
-                infodict = parse_html(thread_id, fpath, rawhtml)
-            except FileNotFoundError:
-                continue
-            infodict['title'] = jsondict[thread_id]['title']
-            infodict['developer'] = jsondict[thread_id]['developer']
-            infodict['version'] = jsondict[thread_id]['version']
-            infodict['views'] = jsondict[thread_id]['views']
-            infodict['likes'] = jsondict[thread_id]['likes']
-            infodict['prefixes'] = jsondict[thread_id]['prefixes']
-            infodict['rating'] = jsondict[thread_id]['rating']
-            infodict['image_cover'] = jsondict[thread_id]['images']['cover']
-            infodict['id'] = thread_id
-            insert_thread(infodict)
+            infodict['user_id'] = int(userchunk.get('data-user-id'))
+        except (TypeError, ValueError):
+            pass
+        infodict['user_name'] = _text(userchunk)
+        infodict['user_url'] = userchunk.get('href')
+    infodict['tags'] = dict()
+    uppercasetags = ['2dcg', '3dcg', 'bdsm', 'ntr', 'pov', 'rpg']
+    for tag in XP_TAGS(maincontent):
+        tagtitle = _text(tag).title()
+        if tagtitle.lower() in uppercasetags:
+            tagtitle = tagtitle.upper()
+        infodict['tags'][tagtitle] = tag.get('href')
+    try:
+        infodict['rating'] = float(_first(XP_RATING(maincontent)))
+    except (TypeError, ValueError):
+        infodict['rating'] = None
+    try:
+        infodict['date'] = int(_first(XP_DATE(maincontent)))
+    except (TypeError, ValueError):
+        infodict['date'] = None
+
+    mc = _first(XP_MESSAGE(maincontent))
+    try:
+        infodict['edited'] = int(_first(XP_EDITED(mc)))
+    except (TypeError, ValueError):
+        infodict['edited'] = infodict['date']
+    mc = _first(XP_BODY(mc))
+    infodict['overview'] = list()
+    text = _text(mc)
+    with timings.stage('extract.overview_scan'):
+        infodict.update(extract_fields(text))
+
+    imagelinks = set()
+    if infodict['overview'] is None or infodict['overview'] == '' or len(infodict['overview']) < 10:
+        bt = ''
+        noscript = _first(XP_NOSCRIPT(mc))
+        if noscript is not None:
+            for node in [noscript] + XP_FOLLOWING(noscript):
+                if isinstance(node, str):
+                    bt = str(node).strip()
+                elif isinstance(node, etree._Comment):
+                    bt = (node.text or '').strip()
+                else:
+                    bt = _text(node)
+                if bt != '':
+                    break
+        infodict['overview'] = bt
+
+    infodict['images'] = list()
+    for image in XP_IMAGES(mc):
+        imgname = _first(XP_IMAGE_ALT(image))
+        imgurl = image.get('href').replace('/thumb/', '/')
+        infodict['images'].append((imgname, imgurl))
+        imagelinks.add(imgurl)
+    infodict['downloadlinks'] = list()
+    span = _first(XP_DOWNLOAD_SPAN(mc))
+    dlinks = XP_ANCHORS(span) if span is not None else XP_EXTERNAL_LINKS(mc)
+    for dlink in dlinks:
+        downloadlink = dlink.get('href')
+        if downloadlink is None:
+            continue
+        if downloadlink not in imagelinks and not downloadlink.startswith('https://f95zone.com/index.php'):
+            infodict['downloadlinks'].append(downloadlink)
+
+    timings.lap('extract', started)
+    return ThreadRecord.from_infodict(infodict)
+
+
+PARSE_ENGINES = {
+    'bs4': parse_html,
+    'lxml': parse_html_lxml,
+}
+
+
+def compare_engines(tasks):
+    """
+    Parses every (thread_id, fpath) task with both engines, prints the pages whose records differ
+    and the time each engine spent. Returns the number of mismatching pages.
+    """
+    from tqdm import tqdm
+    elapsed = {name: 0.0 for name in PARSE_ENGINES}
+    mismatches = 0
+    for thread_id, fpath in tqdm(tasks):
+        st, raw, rawhtml = read_archived(fpath, thread_id) if is_archive(fpath) else read_page(fpath)
+        results = dict()
+        for name, parse in PARSE_ENGINES.items():
+            started = time.perf_counter()
+            results[name] = parse(thread_id, fpath, rawhtml)
+            elapsed[name] += time.perf_counter() - started
+        if results['bs4'] != results['lxml']:
+            mismatches += 1
+            keys = [field for field in ThreadRecord.__slots__
+                    if getattr(results['bs4'], field, None) != getattr(results['lxml'], field, None)]
+            print("Mismatch:", fpath, keys)
+    for name, seconds in elapsed.items():
+        print(f"{name:<5} {seconds:.2f}s, {seconds / max(len(tasks), 1) * 1000:.2f} ms/page")
+    print(f"{mismatches} of {len(tasks)} pages differ")
+    return mismatches
+
+
+THREAD_REFRESH_COLUMNS = ['edited', 'views', 'votes', 'likes', 'pages', 'version', 'rating', 'prefixes', 'updated']
+
+
+def _resolve(session, model, keyname, rows):
+    """
+    Maps the natural keys of a lookup table to their ids, inserting the rows that are missing.
+    rows is an ordered dict of natural key -> column values; new rows get their ids in that order.
+    Keys already in id_cache never reach the database.
+    """
+    from f95_models import chunked
+    column = getattr(model, keyname)
+    idmap, missing = id_cache[model].lookup(rows)
+    if not missing:
+        return idmap
+    if None in missing and session.query(model.id).filter(column.is_(None)).first() is not None:
+        # NULL never conflicts on a unique column, so only insert the "unknown" row once.
+        newrows = [rows[key] for key in missing if key is not None]
+    else:
+        newrows = [rows[key] for key in missing]
+    if newrows:
+        session.execute(model.__table__.insert().prefix_with('OR IGNORE'), newrows)
+    for chunk in chunked(key for key in missing if key is not None):
+        for key, row_id in session.query(column, model.id).filter(column.in_(chunk)):
+            idmap[key] = row_id
+    if None in missing:
+        idmap[None] = session.query(model.id).filter(column.is_(None)).order_by(model.id).first()[0]
+    return idmap
+
+
+def insert_threads(records, index=True, taken=None):
+    """
+    Bulk loads a batch of parsed threads in a single transaction.
+    Every lookup table is resolved with one IN (...) query per chunk of keys, missing lookup rows and
+    association rows are written with INSERT OR IGNORE executemany, and the batch is committed once.
+    With index set the batch is also re-indexed for full-text search; bulk loads rebuild it at the end.
+    Changed metrics are recorded as snapshots taken at unix time taken (default now), one per ingest run.
+    """
+    from f95_models import User, Tag, Image, Developer, Platform, Link, Language, Prefix, Thread, ThreadImage, \
+        ThreadLink, ThreadTag, ThreadPrefix, chunked
+    from search import index_threads
+    from snapshots import record_snapshots
+    from library import title_key
+    records = list(records)
+    users = dict()
+    tags = dict()
+    links = dict()
+    images = dict()
+    developers = dict()
+    platforms = dict()
+    languages = dict()
+    for record in records:
+        if record.user_id is not None:
+            users.setdefault(record.user_id, {'id': record.user_id, 'name': record.user_name, 'url': record.user_url})
+        for tag_name, tag_url in record.tags:
+            tags.setdefault(tag_name, {'name': tag_name, 'url': tag_url})
+        for link in record.downloadlinks:
+            links.setdefault(link, {'url': link})
+        for image_name, image_url in record.images:
+            images.setdefault(image_url, {'name': image_name, 'url': image_url})
+        developers.setdefault(record.developer, {'name': record.developer})
+        platforms.setdefault(record.platform, {'name': record.platform})
+        languages.setdefault(record.language, {'name': record.language})
+
+    with session_scope() as session:
+        started = timings.start()
+        userids, missing = id_cache[User].lookup(users)
+        if missing:
+            session.execute(User.__table__.insert().prefix_with('OR IGNORE'), [users[key] for key in missing])
+            userids.update((key, key) for key in missing)
+        tagids = _resolve(session, Tag, 'name', tags)
+        linkids = _resolve(session, Link, 'url', links)
+        imageids = _resolve(session, Image, 'url', images)
+        developerids = _resolve(session, Developer, 'name', developers)
+        platformids = _resolve(session, Platform, 'name', platforms)
+        languageids = _resolve(session, Language, 'name', languages)
+        started = timings.lap('db_resolve', started)
+
+        threadrows = dict()
+        threadtags = list()
+        threadlinks = list()
+        threadimages = list()
+        threadprefixes = dict()
+        updated = time.time_ns()
+        for record in records:
+            thread_id = record.id
+            # Thread.prefixes keeps the ids as text, ThreadPrefix holds the normalized rows.
+            row = record.thread_row()
+            row['updated'] = updated
+            row['title_key'] = title_key(record.title)
+            if record.prefixes is not None:
+                threadprefixes[thread_id] = record.prefixes
+            row['developer_id'] = developerids[record.developer]
+            row['platform_id'] = platformids[record.platform]
+            row['language_id'] = languageids[record.language]
+            if thread_id in threadrows:
+                # A thread seen twice in one batch behaves like a refresh of the first copy.
+                threadrows[thread_id].update({column: row[column] for column in THREAD_REFRESH_COLUMNS})
+            else:
+                threadrows[thread_id] = row
+            threadtags.extend({'thread_id': thread_id, 'tag_id': tagids[tag_name]} for tag_name, tag_url in record.tags)
+            threadlinks.extend({'thread_id': thread_id, 'link_id': linkids[link]} for link in record.downloadlinks)
+            threadimages.extend({'thread_id': thread_id, 'image_id': imageids[image_url]}
+                                for image_name, image_url in record.images)
+
+        existing = set()
+        for chunk in chunked(threadrows):
+            existing.update(thread_id for thread_id, in session.query(Thread.id).filter(Thread.id.in_(chunk)))
+        refreshed = [{column: row[column] for column in ['id'] + THREAD_REFRESH_COLUMNS}
+                     for thread_id, row in threadrows.items() if thread_id in existing]
+        if refreshed:
+            session.bulk_update_mappings(Thread, refreshed)
+        created = [row for thread_id, row in threadrows.items() if thread_id not in existing]
+        if created:
+            session.execute(Thread.__table__.insert(), created)
+
+        prefixids = sorted({prefix_id for prefixes in threadprefixes.values() for prefix_id in prefixes})
+        if prefixids:
+            # Prefixes missing from prefixes.txt get a nameless row so ThreadPrefix stays consistent.
+            session.execute(Prefix.__table__.insert().prefix_with('OR IGNORE'),
+                            [{'id': prefix_id, 'name': None} for prefix_id in prefixids])
+        for chunk in chunked(thread_id for thread_id in threadprefixes if thread_id in existing):
+            session.query(ThreadPrefix).filter(ThreadPrefix.thread_id.in_(chunk)).delete(synchronize_session=False)
+        threadprefixrows = [{'thread_id': thread_id, 'prefix_id': prefix_id}
+                            for thread_id, prefixes in threadprefixes.items() for prefix_id in prefixes]
+        for model, rows in ((ThreadTag, threadtags), (ThreadLink, threadlinks), (ThreadImage, threadimages),
+                            (ThreadPrefix, threadprefixrows)):
+            if rows:
+                session.execute(model.__table__.insert().prefix_with('OR IGNORE'), rows)
+        record_snapshots(session, threadrows.values(), taken)
+        started = timings.lap('db_write', started)
+        if index:
+            index_threads(session, threadrows)
+            timings.lap('db_search_index', started)
+
+    # Only cache ids once they are committed.
+    for model, idmap in ((User, userids), (Tag, tagids), (Link, linkids), (Image, imageids),
+                         (Developer, developerids), (Platform, platformids), (Language, languageids)):
+        id_cache[model].update(idmap)
+
+
+def insert_thread(record):
+    insert_threads([record])
+
+
+def merge_listing(record, listed):
+    """Overlays the ListingRecord fields of a thread on its parsed page."""
+    record.title = listed.title
+    record.developer = listed.developer
+    record.version = listed.version
+    record.views = listed.views
+    record.likes = listed.likes
+    record.prefixes = listed.prefixes
+    record.rating = listed.rating
+    record.image_cover = listed.image_cover
+
+
+def parse_file(task, engine='bs4'):
+    """
+    Read and parse one saved thread page, from a loose file or a page archive.
+    Runs in the pool workers, so it only returns picklable data.
+    Returns (thread_id, record, filestate); record is None when the content hash matches the
+    known hash passed in the task, filestate is None when the file has disappeared.
+    """
+    thread_id, fpath, known_hash = task
+    try:
+        with timings.stage('read'):
+            st, raw, rawhtml = read_archived(fpath, thread_id) if is_archive(fpath) else read_page(fpath)
+    except FileNotFoundError:
+        return thread_id, None, None
+    filestate = file_state(fpath, st, raw)
+    if known_hash is not None and filestate['hash'] == known_hash:
+        return thread_id, None, filestate
+    return thread_id, PARSE_ENGINES[engine](thread_id, fpath, rawhtml), filestate
+
+
+def init_timed_worker():
+    """Pool initializer: start from empty timers, forked workers would otherwise re-report the parent's."""
+    timings.stages = dict()
+    timings.enabled = True
+
+
+def parse_chunk(tasks, engine='bs4', timed=False):
+    """parse_file over a chunk of tasks in one pool call, plus the worker's stage timings when timed."""
+    results = [parse_file(task, engine) for task in tasks]
+    return results, timings.drain() if timed else None
+
+
+def iter_parsed(tasks, workers=1, engine='bs4', window=PARSE_WINDOW):
+    """
+    Yields parse_file results for every (thread_id, fpath, known_hash) task, in task order.
+    With more than one worker the parsing is spread over a process pool while the
+    caller stays the only process that touches the database. At most about window tasks are
+    submitted or waiting to be consumed at a time, so a slow consumer holds back the pool.
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield parse_file(task, engine)
+        return
+    timed = timings.enabled
+    # Small enough chunks that every worker has a couple of them in flight within the window.
+    size = max(1, min(PARSE_CHUNK, window // (2 * workers)))
+    tasks = iter(tasks)
+    pending = deque()
+    with Pool(processes=workers, initializer=init_timed_worker if timed else None) as pool:
+        while True:
+            while len(pending) * size < window:
+                chunk = list(islice(tasks, size))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(parse_chunk, (chunk, engine, timed)))
+            if not pending:
+                return
+            results, stages = pending.popleft().get()
+            if stages is not None:
+                timings.merge(stages)
+            yield from results
+
+
+def finish_bulk_load(dbengine):
+    """Builds the indexes a bulk load deferred: the secondary indexes and the full-text index."""
+    from f95_models import create_indexes
+    from search import rebuild_search_index
+    with timings.stage('create_indexes'):
+        create_indexes(dbengine)
+    with timings.stage('search_index'), session_scope() as session:
+        rebuild_search_index(session)
+
+
+DOWNLOAD_DIR = r"D:\dazpages\f95"
+
+
+def main(workers=1, batch_size=500, incremental=False, engine='bs4', compare=False, timed=False, profile=0,
+         profiler='cprofile', profile_output=None, timings_json=None, db_path=None, db_profile='default',
+         facet_index=None, similarity_index=None, archive=None, download_dir=DOWNLOAD_DIR, jsondir=None):
+    """Parses the saved pages (or a page archive) into the database through the pipeline stages."""
+    from pipeline import run
+    timings.enabled = timed or timings_json is not None
+    written, stats = run('archive' if archive is not None else 'directory', archive or download_dir, 'sqlite',
+                         jsondir=jsondir or os.path.join(os.getcwd(), "JSON"), workers=workers, engine=engine,
+                         batch_size=batch_size, incremental=incremental, db_path=db_path, db_profile=db_profile,
+                         facet_index=facet_index, similarity_index=similarity_index, compare=compare, profile=profile,
+                         profiler=profiler, profile_output=profile_output)
+    if compare:
+        return
+    if incremental:
+        print(f"{stats['skipped']} unchanged pages skipped")
+    if timings.enabled:
+        print(timings.report())
+        if timings_json is not None:
+            timings.export_json(timings_json)
+    print(id_cache.report())
 
 
 if __name__ == '__main__':
     # with open('outputjson.json', 'w') as jsonfile:
     #    main(jsonfile)
-    main()
+    # pipeline imports pageparse; let it find this module rather than load a second copy with its own engine.
+    sys.modules.setdefault('pageparse', sys.modules[__name__])
+    parser = argparse.ArgumentParser(description="Parse saved f95 thread pages into the database.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of parser processes; 1 parses serially in this process")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="threads written per transaction")
+    parser.add_argument('--incremental', action='store_true',
+                        help="skip pages whose file or edited timestamp has not changed since the last run")
+    parser.add_argument('--engine', choices=sorted(PARSE_ENGINES), default='bs4',
+                        help="page parser: BeautifulSoup or direct lxml/XPath")
+    parser.add_argument('--compare-engines', action='store_true',
+                        help="parse every page with both engines, report differences and timings, write nothing")
+    parser.add_argument('--download-dir', default=DOWNLOAD_DIR, help="directory of the saved thread pages")
+    parser.add_argument('--archive', help="read the pages from this page archive instead of the download directory")
+    parser.add_argument('--json-dir', help="listing dumps to merge, by default JSON in the working directory")
+    parser.add_argument('--db', help="SQLite database file, f95.db3 by default")
+    parser.add_argument('--db-profile', choices=['default', 'bulk', 'query'], default='default',
+                        help="SQLite tuning; bulk also defers secondary index builds to the end of the run")
+    parser.add_argument('--facet-index', help="update (or build) the saved facet index at this path after the run")
+    parser.add_argument('--similarity-index', help="update (or build) the saved similarity index in this directory")
+    parser.add_argument('--timings', action='store_true', help="print per-stage timings at the end of the run")
+    parser.add_argument('--timings-json', help="also write the per-stage timing histograms to this JSON file")
+    parser.add_argument('--profile', type=int, default=0, metavar='N',
+                        help="profile parsing of the first N pages before the run")
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile')
+    parser.add_argument('--profile-output', help="write the raw profile (.prof, or .html for pyinstrument) here")
+    args = parser.parse_args()
+    main(workers=args.workers, batch_size=args.batch_size, incremental=args.incremental, engine=args.engine,
+         compare=args.compare_engines, timed=args.timings, profile=args.profile, profiler=args.profiler,
+         profile_output=args.profile_output, timings_json=args.timings_json, db_path=args.db,
+         db_profile=args.db_profile, facet_index=args.facet_index, similarity_index=args.similarity_index,
+         archive=args.archive, download_dir=args.download_dir, jsondir=args.json_dir)
@@ -0,0 +1,389 @@
+import os
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from tqdm import tqdm
+import pageparse
+from f95_models import drop_indexes, DEFAULT_DB_PATH
+from instrument import timings, profile_call
+from listing import load_listing
+from manifest import content_hash, file_state, load_manifest, load_validators, stat_unchanged, update_manifest, \
+    update_validators
+from pagearchive import is_archive, open_archive, thread_id_from_filename
+
+
+# Items a stage may run ahead of the next one.
+QUEUE_SIZE = 64
+_END = object()
+
+
+class _Raised:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _pump(produce, size):
+    """
+    Calls produce(put) in a background thread and yields what it puts. put blocks while the queue is
+    full and returns False once the consumer has stopped, which tells the producer to give up.
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce_all():
+        try:
+            produce(put)
+            put(_END)
+        except BaseException as exc:
+            put(_Raised(exc))
+
+    thread = threading.Thread(target=produce_all, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, _Raised):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+
+
+def buffered(iterable, size=QUEUE_SIZE):
+    """
+    Iterates iterable in a background thread, at most size items ahead of the consumer, so a stage
+    overlaps with the next one while a slow consumer still holds back its producer.
+    """
+    def produce(put):
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+    return _pump(produce, size)
+
+
+def iterate_async(aiterable, size=QUEUE_SIZE):
+    """Drives an async iterator on its own event loop thread and yields its items through a bounded queue."""
+    async def drain(put):
+        async for item in aiterable:
+            if not await asyncio.to_thread(put, item):
+                return
+    return _pump(lambda put: asyncio.run(drain(put)), size)
+
+
+# Sources: (thread_id, location)
+
+def directory_pages(download_dir):
+    """Yields (thread_id, path) for the saved thread-<id>.html pages in download_dir."""
+    for root, dirs, files in os.walk(download_dir):
+        for file in files:
+            try:
+                thread_id = thread_id_from_filename(file)
+            except (IndexError, ValueError):
+                print("Not a thread page:", file)
+                continue
+            yield thread_id, os.path.join(root, file)
+
+
+def archive_pages(path):
+    """Yields (thread_id, archive path) for every page of a page archive, in file order."""
+    for thread_id in open_archive(path).thread_ids():
+        yield thread_id, path
+
+
+def source_pages(source, location, shard=None, shards=1, partition='hash'):
+    """The (thread_id, location) pages of a directory or archive source, or of one shard of it."""
+    pages = archive_pages(location) if source == 'archive' else directory_pages(location)
+    if shard is not None:
+        from shards import shard_pages
+        pages = shard_pages(pages, shard, shards, partition)
+    return list(pages)
+
+
+def select_tasks(pages, manifest=None, stats=None):
+    """
+    Turns (thread_id, location) pages into parse tasks (thread_id, location, known_hash). With a
+    manifest, pages whose size and mtime are unchanged are dropped and the others carry their last
+    content hash.
+    """
+    for thread_id, location in pages:
+        if manifest is None:
+            yield thread_id, location, None
+            continue
+        entry = manifest.get(thread_id)
+        try:
+            st = open_archive(location).stat(thread_id) if is_archive(location) else os.stat(location)
+        except (FileNotFoundError, KeyError):
+            continue
+        if stat_unchanged(entry, location, st):
+            if stats is not None:
+                stats['skipped'] += 1
+            continue
+        yield thread_id, location, entry.hash if entry is not None else None
+
+
+# Parse stages: (thread_id, records.ThreadRecord, filestate)
+
+def parse_tasks(tasks, workers=1, engine='bs4', size=QUEUE_SIZE):
+    """Parses the tasks, in a process pool when workers > 1 with at most about size tasks in flight."""
+    return pageparse.iter_parsed(tasks, workers, engine, size)
+
+
+def fetch_pages(fetcher, thread_ids, workers=1, engine='lxml', size=QUEUE_SIZE, stats=None):
+    """
+    Fetches and parses threads with a fetcher.PageFetcher. Fetched pages carry their HTTP validators
+    in the filestate; 304 Not Modified and failed fetches are only counted in stats.
+    """
+    from fetcher import fetch_and_parse
+
+    for result, record in iterate_async(fetch_and_parse(fetcher, thread_ids, workers, engine, size), size):
+        if record is None:
+            if stats is not None:
+                stats['not modified' if result.status == 304 else 'failed'] += 1
+            continue
+        if stats is not None:
+            stats['fetched'] += 1
+        if result.path is not None:
+            filestate = file_state(result.path, os.stat(result.path), result.body)
+        else:
+            filestate = {'path': None, 'size': len(result.body), 'mtime': None, 'hash': content_hash(result.body),
+                         'edited': None}
+        filestate.update(etag=result.etag, last_modified=result.last_modified)
+        yield result.thread_id, record, filestate
+
+
+# Enrich
+
+def enrich(parsed, listing, manifest=None, incremental=False, stats=None):
+    """
+    Merges the listing fields into every parsed thread and fills in the manifest columns of its
+    filestate. Threads whose content hash or edited timestamp is unchanged (the latter only when
+    incremental) come out with record None, so sinks only refresh their manifest row.
+    """
+    manifest = dict() if manifest is None else manifest
+    for thread_id, record, filestate in parsed:
+        if filestate is None:
+            continue
+        entry = manifest.get(thread_id)
+        filestate['thread_id'] = thread_id
+        if record is None:
+            filestate['edited'] = entry.edited if entry is not None else None
+        else:
+            filestate['edited'] = record.edited
+            if incremental and entry is not None and entry.edited == record.edited:
+                record = None
+        if record is None:
+            if stats is not None:
+                stats['skipped'] += 1
+            yield thread_id, None, filestate
+            continue
+        if thread_id in listing:
+            pageparse.merge_listing(record, listing[thread_id])
+        record.id = thread_id
+        yield thread_id, record, filestate
+
+
+# Sinks: consume the enriched items, return the ids of the threads written
+
+def sqlite_sink(items, batch_size=500, index=True, taken=None):
+    """
+    Writes enriched items to the database, batch_size threads per transaction, along with their
+    manifest rows and HTTP validators.
+    """
+    taken = int(time.time()) if taken is None else taken
+    batch = list()
+    manifestrows = list()
+    validators = list()
+    written = list()
+
+    def flush():
+        if batch:
+            pageparse.insert_threads(batch, index=index, taken=taken)
+        with pageparse.session_scope() as session:
+            update_manifest(session, manifestrows)
+            update_validators(session, validators)
+        batch.clear()
+        manifestrows.clear()
+        validators.clear()
+
+    for thread_id, record, filestate in items:
+        if filestate.get('path') is not None:
+            manifestrows.append(filestate)
+        if filestate.get('etag') is not None or filestate.get('last_modified') is not None:
+            validators.append({'thread_id': thread_id, 'etag': filestate['etag'],
+                               'last_modified': filestate['last_modified']})
+        if record is not None:
+            batch.append(record)
+            written.append(thread_id)
+        if len(batch) >= batch_size or len(manifestrows) >= batch_size:
+            flush()
+    flush()
+    return written
+
+
+def jsonl_sink(items, path):
+    """Writes every changed thread's record as one JSON line."""
+    written = list()
+    with open(path, 'w', encoding='UTF-8') as jsonfile:
+        for thread_id, record, filestate in items:
+            if record is not None:
+                jsonfile.write(json.dumps(record.to_dict(), ensure_ascii=False) + '\n')
+                written.append(thread_id)
+    return written
+
+
+def parquet_sink(items, path, batch_size=5000):
+    """Writes changed threads to one Parquet file laid out like the export.py parts."""
+    import pyarrow.parquet as pq
+    from export import THREAD_SCHEMA, record_batch
+    from f95_models import read_prefixes
+    prefix_names = {row['id']: row['name'] for row in read_prefixes()}
+    written = list()
+    batch = list()
+    with pq.ParquetWriter(path, THREAD_SCHEMA, compression='zstd') as writer:
+        for thread_id, record, filestate in items:
+            if record is not None:
+                batch.append(record)
+                written.append(thread_id)
+            if len(batch) >= batch_size:
+                writer.write_batch(record_batch(batch, prefix_names))
+                batch = list()
+        if batch:
+            writer.write_batch(record_batch(batch, prefix_names))
+    return written
+
+
+def run(source='directory', location=None, sink='sqlite', output=None, jsondir=None, thread_ids=None, fetcher=None,
+        workers=1, engine='bs4', batch_size=500, incremental=False, queue_size=QUEUE_SIZE, db_path=DEFAULT_DB_PATH,
+        db_profile='default', facet_index=None, similarity_index=None, compare=False, profile=0, profiler='cprofile',
+        profile_output=None, shard=None, shards=1, partition='hash'):
+    """
+    Streams a source ('directory', 'archive' or 'fetch') through parse and enrich into a sink ('sqlite',
+    'parquet' or 'jsonl'). Parsing runs in its own thread (and pool) up to queue_size items ahead of
+    the sink. With shard set only that shard of shards (see shards.py) is read. Threads the sqlite sink
+    does not rewrite still get a snapshot of their changed listing metrics.
+    Returns (ids of the threads written, counts of skipped/fetched/not modified/failed pages).
+    """
+    stats = {'skipped': 0, 'fetched': 0, 'not modified': 0, 'failed': 0}
+    manifest = None
+    taken = int(time.time())
+    if compare and source != 'fetch':
+        # Parse only: nothing is read from or written to the database.
+        pageparse.compare_engines(source_pages(source, location, shard, shards, partition))
+        return list(), stats
+    if sink == 'sqlite':
+        dbengine = pageparse.init_db(db_path, db_profile)
+        if db_profile == 'bulk':
+            drop_indexes(dbengine)
+    with timings.stage('listing'):
+        listing = load_listing(jsondir) if jsondir is not None else dict()
+    if sink == 'sqlite':
+        with pageparse.session_scope() as session:
+            pageparse.id_cache.warm(session)
+            manifest = load_manifest(session)
+            if fetcher is not None:
+                fetcher.validators.update(load_validators(session))
+    if source == 'fetch':
+        thread_ids = thread_ids if thread_ids is not None else sorted(listing)
+        if shard is not None:
+            from shards import shard_ids
+            thread_ids = shard_ids(thread_ids, shard, shards, partition)
+        seen = thread_ids
+        parsed = fetch_pages(fetcher, thread_ids, workers, engine, queue_size, stats)
+        total = None
+    else:
+        pages = source_pages(source, location, shard, shards, partition)
+        seen = [thread_id for thread_id, location in pages]
+        tasks = list(select_tasks(pages, manifest if incremental else None, stats))
+        if profile:
+            sample = [(thread_id, fpath, None) for thread_id, fpath, known_hash in tasks[:profile]]
+            enabled, timings.enabled = timings.enabled, False
+            profile_call(lambda: [pageparse.parse_file(task, engine) for task in sample], profile_output, profiler)
+            timings.enabled = enabled
+        parsed = parse_tasks(tasks, workers, engine, queue_size)
+        total = len(tasks)
+    items = enrich(tqdm(buffered(parsed, queue_size), total=total), listing, manifest, incremental, stats)
+    if sink == 'parquet':
+        return parquet_sink(items, output), stats
+    if sink == 'jsonl':
+        return jsonl_sink(items, output), stats
+    written = sqlite_sink(items, batch_size, index=db_profile != 'bulk', taken=taken)
+    if listing:
+        from snapshots import record_listing_snapshots
+        with pageparse.session_scope() as session:
+            record_listing_snapshots(session, listing, sorted(set(seen).difference(written)), taken)
+    if db_profile == 'bulk':
+        pageparse.finish_bulk_load(dbengine)
+    if facet_index is not None:
+        from facets import update_facet_index
+        with timings.stage('facet_index'), pageparse.session_scope() as session:
+            update_facet_index(facet_index, session, written)
+    if similarity_index is not None:
+        from similarity import update_similarity_index
+        with timings.stage('similarity_index'), pageparse.session_scope() as session:
+            update_similarity_index(similarity_index, session, written)
+    return written, stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stream thread pages from a source through the parser into a sink.")
+    parser.add_argument('source', choices=['directory', 'archive', 'fetch'])
+    parser.add_argument('location', nargs='?', help="download directory or page archive (not used by fetch)")
+    parser.add_argument('--sink', choices=['sqlite', 'parquet', 'jsonl'], default='sqlite')
+    parser.add_argument('--output', help="output file of the parquet and jsonl sinks")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="database of the sqlite sink")
+    parser.add_argument('--db-profile', choices=['default', 'bulk', 'query'], default='default')
+    parser.add_argument('--json-dir', default=os.path.join(os.getcwd(), 'JSON'), help="listing dumps to merge")
+    parser.add_argument('--threads', type=int, nargs='*', help="thread ids to fetch; defaults to the listing")
+    parser.add_argument('--base-url', help="forum to fetch from")
+    parser.add_argument('--rate', type=float, default=2.0, help="fetch requests per second per host")
+    parser.add_argument('--save-dir', help="also keep fetched pages here")
+    parser.add_argument('--workers', type=int, default=1, help="parser processes")
+    parser.add_argument('--engine', choices=sorted(pageparse.PARSE_ENGINES), default='lxml')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help="items a stage may run ahead")
+    parser.add_argument('--incremental', action='store_true', help="skip unchanged pages (sqlite sink only)")
+    parser.add_argument('--facet-index', help="update the saved facet index after a sqlite run")
+    parser.add_argument('--similarity-index', help="update the saved similarity index after a sqlite run")
+    parser.add_argument('--shard', type=int, help="only read this shard (0-based) of --shards")
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--partition', choices=['hash', 'range'], default='hash',
+                        help="split threads by id hash or into id ranges")
+    args = parser.parse_args()
+    if args.source != 'fetch' and args.location is None:
+        parser.error(f"the {args.source} source needs a location")
+    if args.shard is not None and not 0 <= args.shard < args.shards:
+        parser.error("--shard must be between 0 and --shards - 1")
+    if args.sink != 'sqlite' and args.output is None:
+        parser.error(f"the {args.sink} sink needs --output")
+    page_fetcher = None
+    if args.source == 'fetch':
+        from fetcher import PageFetcher, BASE_URL
+        if args.save_dir is not None:
+            os.makedirs(args.save_dir, exist_ok=True)
+        page_fetcher = PageFetcher(args.base_url or BASE_URL, rate=args.rate, save_dir=args.save_dir)
+    started = time.perf_counter()
+    ids, counts = run(args.source, args.location, args.sink, args.output,
+                      args.json_dir if os.path.isdir(args.json_dir) else None, args.threads, page_fetcher,
+                      args.workers, args.engine, args.batch_size, args.incremental, args.queue_size, args.db,
+                      args.db_profile, args.facet_index, args.similarity_index, shard=args.shard, shards=args.shards,
+                      partition=args.partition)
+    print(f"{len(ids)} threads written in {time.perf_counter() - started:.1f}s", counts)
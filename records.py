@@ -0,0 +1,125 @@
+from functools import lru_cache
+import msgpack
+
+
+@lru_cache(maxsize=None)
+def thread_columns():
+    """The f95_models.Thread column names. The models are only imported once a record is written."""
+    from f95_models import Thread
+    return tuple(column.name for column in Thread.__table__.columns)
+
+
+class ThreadRecord:
+    """
+    One parsed thread: the page fields, plus the listing fields once merge_listing has run. Lists are
+    tuples (tags and images as (name, url) pairs), so a record packs straight into msgpack and
+    pickles as one flat tuple when it crosses a process pool.
+    """
+    PAGE_FIELDS = ('id', 'canonical', 'title', 'details', 'user_id', 'user_name', 'user_url', 'mainimage', 'pages',
+                   'votes', 'images', 'links', 'tags', 'rating', 'date', 'edited', 'overview', 'developer',
+                   'platform', 'censorship', 'language', 'downloadlinks')
+    LISTING_FIELDS = ('version', 'views', 'likes', 'prefixes', 'image_cover')
+    __slots__ = PAGE_FIELDS + LISTING_FIELDS
+    # Fields holding tuples, and for tags and images tuples of (name, url) pairs.
+    TUPLE_FIELDS = ('images', 'links', 'tags', 'downloadlinks')
+
+    def __init__(self, id, canonical=None, title=None, details=None, user_id=None, user_name=None, user_url=None,
+                 mainimage=None, pages=None, votes=None, images=(), links=(), tags=(), rating=None, date=None,
+                 edited=None, overview=None, developer=None, platform=None, censorship=None, language=None,
+                 downloadlinks=(), version=None, views=None, likes=None, prefixes=None, image_cover=None):
+        self.id = id
+        self.canonical = canonical
+        self.title = title
+        self.details = details
+        self.user_id = user_id
+        self.user_name = user_name
+        self.user_url = user_url
+        self.mainimage = mainimage
+        self.pages = pages
+        self.votes = votes
+        self.images = images
+        self.links = links
+        self.tags = tags
+        self.rating = rating
+        self.date = date
+        self.edited = edited
+        self.overview = overview
+        self.developer = developer
+        self.platform = platform
+        self.censorship = censorship
+        self.language = language
+        self.downloadlinks = downloadlinks
+        self.version = version
+        self.views = views
+        self.likes = likes
+        self.prefixes = prefixes
+        self.image_cover = image_cover
+
+    @classmethod
+    def from_infodict(cls, infodict):
+        """Builds a record from a parser's working dict; missing keys keep their defaults."""
+        values = {field: infodict[field] for field in cls.__slots__ if field in infodict}
+        for field in cls.TUPLE_FIELDS:
+            if field in values:
+                value = values[field]
+                values[field] = tuple(value.items()) if isinstance(value, dict) else tuple(value)
+        return cls(**values)
+
+    def astuple(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def to_dict(self, fields=None):
+        """Plain dict of the record, with tags as {name: url}, e.g. for JSON output."""
+        result = {field: getattr(self, field) for field in fields or self.__slots__}
+        if 'tags' in result:
+            result['tags'] = dict(result['tags'])
+        return result
+
+    def thread_row(self):
+        """
+        The record's values for every f95_models.Thread column, with prefixes as comma-separated ids.
+        Columns that need a lookup (developer_id, ...) are None.
+        """
+        row = {column: getattr(self, column, None) for column in thread_columns()}
+        if self.prefixes is not None:
+            row['prefixes'] = ','.join(str(prefix_id) for prefix_id in self.prefixes)
+        return row
+
+    def pack(self):
+        return msgpack.packb(self.astuple())
+
+    @classmethod
+    def unpack(cls, data):
+        return cls(*msgpack.unpackb(data, use_list=False))
+
+    def __reduce__(self):
+        return ThreadRecord, self.astuple()
+
+    def __eq__(self, other):
+        return isinstance(other, ThreadRecord) and self.astuple() == other.astuple()
+
+    def __repr__(self):
+        return f"ThreadRecord(id={self.id!r}, title={self.title!r})"
+
+
+def pack_records(records):
+    """A whole batch of records as one msgpack array."""
+    return msgpack.packb([record.astuple() for record in records])
+
+
+def unpack_records(data):
+    return [ThreadRecord(*values) for values in msgpack.unpackb(data, use_list=False)]
+
+
+def spill(records, path):
+    """Appends records to a spill file, one msgpack array per record."""
+    with open(path, 'ab') as spillfile:
+        for record in records:
+            spillfile.write(record.pack())
+
+
+def iter_spilled(path):
+    """Yields the records of a spill file in the order they were written."""
+    with open(path, 'rb') as spillfile:
+        for values in msgpack.Unpacker(spillfile, use_list=False):
+            yield ThreadRecord(*values)
@@ -0,0 +1,96 @@
+import argparse
+from collections import namedtuple
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import sessionmaker
+from f95_models import db_connect, chunked, in_list, DEFAULT_DB_PATH
+
+
+FTS_TABLE = 'thread_fts'
+# Relative bm25 weights of the indexed columns: title, overview, developer, tags.
+COLUMN_WEIGHTS = (10.0, 1.0, 5.0, 3.0)
+
+SearchHit = namedtuple('SearchHit', ['thread_id', 'rank', 'title', 'snippet'])
+
+FTS_ROWS = '''
+    SELECT thread.id, thread.title, thread.overview, developer.name,
+           (SELECT group_concat(tag.name, ' ') FROM threadtag JOIN tag ON tag.id = threadtag.tag_id
+            WHERE threadtag.thread_id = thread.id)
+    FROM thread LEFT JOIN developer ON developer.id = thread.developer_id
+'''
+
+
+def create_search_index(engine):
+    """
+    Creates the FTS5 table over thread title, overview, developer name and tag names. An index that is
+    empty next to existing threads (new on an old catalogue, or dropped) is filled from the thread tables,
+    since later runs only re-index the threads they write.
+    """
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"title, overview, developer, tags, tokenize = 'unicode61 remove_diacritics 2')"))
+        empty, = connection.execute(text(f"SELECT NOT EXISTS (SELECT 1 FROM {FTS_TABLE})")).fetchone()
+        if empty and inspect(connection).has_table('thread'):
+            if connection.execute(text("SELECT EXISTS (SELECT 1 FROM thread)")).scalar():
+                rebuild_search_index(connection)
+
+
+def rebuild_search_index(session):
+    """Refills the whole index from the thread tables, e.g. after a bulk load."""
+    session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    session.execute(text(f"INSERT INTO {FTS_TABLE} (rowid, title, overview, developer, tags) {FTS_ROWS}"))
+    session.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')"))
+
+
+def index_threads(session, thread_ids):
+    """Re-indexes the given threads inside the caller's transaction."""
+    for chunk in chunked(thread_ids):
+        placeholders, params = in_list(chunk)
+        session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})"), params)
+        session.execute(text(f"INSERT INTO {FTS_TABLE} (rowid, title, overview, developer, tags) {FTS_ROWS} "
+                             f"WHERE thread.id IN ({placeholders})"), params)
+
+
+def fts_query(words):
+    """Turns free text into an FTS5 query that ANDs every word, the last one as a prefix."""
+    terms = ['"{}"'.format(word.replace('"', '""')) for word in words.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search(session, query, limit=20, offset=0, raw=False):
+    """
+    Returns SearchHits for the best matching threads, best first. query is free text unless raw is
+    set, in which case it is passed to FTS5 MATCH as is (column filters, OR, NEAR, ...).
+    """
+    match = query if raw else fts_query(query)
+    if not match:
+        return list()
+    weights = ', '.join(str(weight) for weight in COLUMN_WEIGHTS)
+    rows = session.execute(text(
+        f"SELECT rowid, bm25({FTS_TABLE}, {weights}) AS rank, title, "
+        f"snippet({FTS_TABLE}, -1, '[', ']', '...', 16) "
+        f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match ORDER BY rank LIMIT :limit OFFSET :offset"),
+        {'match': match, 'limit': limit, 'offset': offset})
+    return [SearchHit(*row) for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Full-text search over the thread catalogue.")
+    parser.add_argument('query', nargs='?', help="search words")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--raw', action='store_true', help="pass the query to FTS5 MATCH unchanged")
+    parser.add_argument('--rebuild', action='store_true', help="rebuild the index from the thread tables first")
+    args = parser.parse_args()
+    engine = db_connect(args.db, 'query')
+    create_search_index(engine)
+    session = sessionmaker(bind=engine)()
+    if args.rebuild:
+        rebuild_search_index(session)
+        session.commit()
+    if args.query:
+        for hit in search(session, args.query, args.limit, raw=args.raw):
+            print(f"{hit.thread_id:>8} {hit.rank:8.2f}  {hit.title}\n          {hit.snippet}")
+    session.close()
@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+from bisect import bisect_right
+from sqlalchemy import text
+from f95_models import db_connect, create_tables, create_indexes, drop_indexes, seed_prefixes, DEFAULT_DB_PATH, \
+    User, Prefix, Tag, Link, Image, Developer, Platform, Language, Thread, ThreadTag, ThreadLink, ThreadImage, \
+    ThreadPrefix, Manifest, Snapshot
+from search import create_search_index, rebuild_search_index
+
+
+PARTITIONS = ('hash', 'range')
+PIPELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline.py')
+# Lookup tables whose ids differ from shard to shard, reconciled by their natural key.
+NATURAL_KEYS = [(Tag, 'name'), (Link, 'url'), (Image, 'url'), (Developer, 'name'), (Platform, 'name'),
+                (Language, 'name')]
+# Foreign key columns pointing into those tables: table -> {column: lookup table}.
+FOREIGN_KEYS = {
+    Thread: {'developer_id': 'developer', 'platform_id': 'platform', 'language_id': 'language'},
+    ThreadTag: {'tag_id': 'tag'},
+    ThreadLink: {'link_id': 'link'},
+    ThreadImage: {'image_id': 'image'},
+    ThreadPrefix: {},
+}
+
+
+def hash_shard(thread_id, shards):
+    """The shard of a thread under hash partitioning; the same on every host and Python version."""
+    return ((thread_id * 2654435761) & 0xFFFFFFFF) * shards >> 32
+
+
+def range_bounds(thread_ids, shards):
+    """Thread id boundaries that split thread_ids into shards ranges of about equal size."""
+    thread_ids = sorted(set(thread_ids))
+    return [thread_ids[len(thread_ids) * n // shards] for n in range(1, shards)] if thread_ids else list()
+
+
+def shard_ids(thread_ids, shard, shards, partition='hash'):
+    """
+    The ids of thread_ids that belong to shard (0-based) of shards, in their original order. Range
+    partitioning splits the ids given, so every worker has to see the same thread_ids.
+    """
+    thread_ids = list(thread_ids)
+    if partition == 'hash':
+        return [thread_id for thread_id in thread_ids if hash_shard(thread_id, shards) == shard]
+    bounds = range_bounds(thread_ids, shards)
+    return [thread_id for thread_id in thread_ids if bisect_right(bounds, thread_id) == shard]
+
+
+def shard_pages(pages, shard, shards, partition='hash'):
+    """The (thread_id, location) pages of one shard."""
+    pages = list(pages)
+    keep = set(shard_ids([thread_id for thread_id, location in pages], shard, shards, partition))
+    return [(thread_id, location) for thread_id, location in pages if thread_id in keep]
+
+
+def shard_path(outdir, shard, shards):
+    return os.path.join(outdir, f'shard-{shard:03d}-of-{shards:03d}.db3')
+
+
+def _columns(model, skip=()):
+    return [column.name for column in model.__table__.columns if column.name not in skip]
+
+
+def merge_shard(connection, path):
+    """
+    Merges the shard database at path into the database of connection with INSERT ... SELECT over an
+    ATTACHed file. Lookup rows are matched by natural key and new ones appended in shard order, so
+    merging the same shards in the same order always gives the same ids. A thread already in the main
+    database is replaced only when the shard copy was written later. Merged threads are stamped with the
+    merge time, so incremental exports pick them up. Returns the number of threads merged.
+    """
+    updated = time.time_ns()
+    connection.execute(text("ATTACH DATABASE :path AS shard"), {'path': path})
+    connection.commit()
+    try:
+        for model in (User, Prefix):
+            columns = ', '.join(_columns(model))
+            connection.execute(text(f"INSERT OR IGNORE INTO main.{model.__tablename__} ({columns}) "
+                                    f"SELECT {columns} FROM shard.{model.__tablename__}"))
+        for model, key in NATURAL_KEYS:
+            table = model.__tablename__
+            columns = ', '.join(_columns(model, skip=('id',)))
+            connection.execute(text(f"INSERT OR IGNORE INTO main.{table} ({columns}) "
+                                    f"SELECT {columns} FROM shard.{table} WHERE {key} IS NOT NULL ORDER BY id"))
+            # NULL never conflicts on a unique column, so the "unknown" row is only copied when missing.
+            connection.execute(text(f"INSERT INTO main.{table} ({columns}) "
+                                    f"SELECT {columns} FROM shard.{table} WHERE {key} IS NULL "
+                                    f"AND NOT EXISTS (SELECT 1 FROM main.{table} WHERE {key} IS NULL) "
+                                    f"ORDER BY id LIMIT 1"))
+            connection.execute(text(f"CREATE TEMP TABLE map_{table} (old INTEGER PRIMARY KEY, new INTEGER)"))
+            connection.execute(text(f"INSERT INTO temp.map_{table} SELECT s.id, m.id FROM shard.{table} AS s "
+                                    f"JOIN main.{table} AS m ON m.{key} = s.{key}"))
+            connection.execute(text(f"INSERT INTO temp.map_{table} SELECT id, "
+                                    f"(SELECT min(id) FROM main.{table} WHERE {key} IS NULL) "
+                                    f"FROM shard.{table} WHERE {key} IS NULL"))
+
+        connection.execute(text("CREATE TEMP TABLE merged (id INTEGER PRIMARY KEY)"))
+        connection.execute(text("INSERT INTO temp.merged SELECT s.id FROM shard.thread AS s "
+                                "LEFT JOIN main.thread AS m ON m.id = s.id "
+                                "WHERE m.id IS NULL OR coalesce(m.updated, 0) <= coalesce(s.updated, 0)"))
+        merged, = connection.execute(text("SELECT count(*) FROM temp.merged")).fetchone()
+        for model, mapped in FOREIGN_KEYS.items():
+            table = model.__tablename__
+            key = 'id' if model is Thread else 'thread_id'
+            columns = _columns(model, skip=() if model is Thread else ('id',))
+            values = ', '.join(f'map_{mapped[column]}.new' if column in mapped else
+                               ':updated' if model is Thread and column == 'updated' else f's.{column}'
+                               for column in columns)
+            joins = ' '.join(f'LEFT JOIN temp.map_{lookup} ON map_{lookup}.old = s.{column}'
+                             for column, lookup in mapped.items())
+            if model is not Thread:
+                connection.execute(text(f"DELETE FROM main.{table} WHERE thread_id IN (SELECT id FROM temp.merged)"))
+            # Association rows keep their page order, which readers follow through the row id.
+            connection.execute(text(f"INSERT OR REPLACE INTO main.{table} ({', '.join(columns)}) SELECT {values} "
+                                    f"FROM shard.{table} AS s JOIN temp.merged ON merged.id = s.{key} {joins} "
+                                    f"ORDER BY s.id"), {'updated': updated})
+
+        columns = ', '.join(_columns(Manifest))
+        connection.execute(text(f"INSERT OR REPLACE INTO main.manifest ({columns}) SELECT {columns} "
+                                f"FROM shard.manifest AS s WHERE s.thread_id IN (SELECT id FROM temp.merged) "
+                                f"OR NOT EXISTS (SELECT 1 FROM main.manifest AS m WHERE m.thread_id = s.thread_id)"))
+        columns = ', '.join(_columns(Snapshot))
+        connection.execute(text(f"INSERT OR IGNORE INTO main.snapshot ({columns}) SELECT {columns} "
+                                f"FROM shard.snapshot"))
+        connection.commit()
+    except:
+        connection.rollback()
+        raise
+    finally:
+        for model, key in NATURAL_KEYS:
+            connection.execute(text(f"DROP TABLE IF EXISTS temp.map_{model.__tablename__}"))
+        connection.execute(text("DROP TABLE IF EXISTS temp.merged"))
+        connection.execute(text("DETACH DATABASE shard"))
+        connection.commit()
+    return merged
+
+
+def merge_shards(db_path, shard_paths, profile='bulk'):
+    """
+    Merges the shard databases, in the order given, into the database at db_path, then rebuilds its
+    indexes and full-text index. The bulk profile drops the secondary indexes for the merge.
+    Returns the number of threads merged.
+    """
+    engine = db_connect(db_path, profile)
+    create_tables(engine, indexes=profile != 'bulk')
+    seed_prefixes(engine)
+    create_search_index(engine)
+    if profile == 'bulk':
+        drop_indexes(engine)
+    merged = 0
+    with engine.connect() as connection:
+        for path in shard_paths:
+            started = time.perf_counter()
+            count = merge_shard(connection, path)
+            print(f"{path}: {count} threads merged in {time.perf_counter() - started:.2f}s")
+            merged += count
+    create_indexes(engine)
+    with engine.begin() as connection:
+        rebuild_search_index(connection)
+    engine.dispose()
+    return merged
+
+
+def ingest_shards(source, location, shards, outdir, partition='hash', workers=1, engine='lxml', jsondir=None):
+    """
+    Runs one pipeline.py process per shard on this host, each writing its own shard database in outdir,
+    and waits for them. On several hosts run pipeline.py --shard I --shards N directly instead.
+    Returns the shard database paths.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    paths = [shard_path(outdir, shard, shards) for shard in range(shards)]
+    processes = list()
+    for shard, path in enumerate(paths):
+        command = [sys.executable, PIPELINE_PATH, source, location, '--db', path, '--db-profile', 'bulk',
+                   '--shard', str(shard), '--shards', str(shards), '--partition', partition,
+                   '--workers', str(workers), '--engine', engine]
+        if jsondir is not None:
+            command += ['--json-dir', jsondir]
+        processes.append(subprocess.Popen(command))
+    failed = [path for path, process in zip(paths, processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shard ingest failed for {', '.join(failed)}")
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sharded ingest into per-shard databases and their merge.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest = commands.add_parser('ingest', help="ingest a page directory or archive as N local shards")
+    ingest.add_argument('source', choices=['directory', 'archive'])
+    ingest.add_argument('location')
+    ingest.add_argument('--shards', type=int, required=True)
+    ingest.add_argument('--outdir', required=True, help="directory for the shard databases")
+    ingest.add_argument('--partition', choices=PARTITIONS, default='hash')
+    ingest.add_argument('--workers', type=int, default=1, help="parser processes per shard")
+    ingest.add_argument('--engine', choices=['bs4', 'lxml'], default='lxml')
+    ingest.add_argument('--json-dir', help="listing dumps to merge")
+    ingest.add_argument('--merge-into', help="merge the shards into this database afterwards")
+    merge = commands.add_parser('merge', help="merge shard databases into the main database")
+    merge.add_argument('shards', nargs='+', help="shard database files, merged in the order given")
+    merge.add_argument('--db', default=DEFAULT_DB_PATH)
+    merge.add_argument('--db-profile', choices=['default', 'bulk'], default='bulk')
+    args = parser.parse_args()
+    started = time.perf_counter()
+    if args.command == 'ingest':
+        shard_paths = ingest_shards(args.source, args.location, args.shards, args.outdir, args.partition,
+                                    args.workers, args.engine, args.json_dir)
+        print(f"{args.shards} shards ingested in {time.perf_counter() - started:.1f}s")
+        if args.merge_into is not None:
+            merged = merge_shards(args.merge_into, shard_paths)
+            print(f"{merged} threads merged into {args.merge_into} in {time.perf_counter() - started:.1f}s")
+    else:
+        merged = merge_shards(args.db, args.shards, args.db_profile)
+        print(f"{merged} threads merged into {args.db} in {time.perf_counter() - started:.1f}s")
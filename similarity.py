@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from f95_models import db_connect, chunked, in_list, int_rows, DEFAULT_DB_PATH
+
+
+# kind -> (thread id, value id) pairs. A feature is keyed kind number << 32 | value id.
+FEATURE_SOURCES = {
+    'tag': "SELECT thread_id, tag_id FROM threadtag",
+    'developer': "SELECT thread.id, thread.developer_id FROM thread "
+                 "JOIN developer ON developer.id = thread.developer_id WHERE developer.name IS NOT NULL",
+    'prefix': "SELECT thread_id, prefix_id FROM threadprefix",
+}
+PAIR_FILTERS = {
+    'tag': "thread_id",
+    'developer': "thread.id",
+    'prefix': "thread_id",
+}
+KINDS = list(FEATURE_SOURCES)
+# Weight of each kind on top of the IDF: a shared developer says more than a shared tag, and prefixes
+# (engine, status) say the least.
+FEATURE_WEIGHTS = {'tag': 1.0, 'developer': 1.5, 'prefix': 0.5}
+NEIGHBOURS = 20
+# Threads scored per product; each batch holds a BATCH_ROWS x threads float32 block.
+BATCH_ROWS = 256
+# Features at least this many threads share (the common tags and prefixes) are multiplied as a dense
+# block, at most DENSE_COLUMNS of them: a sparse product over them would have an almost dense result.
+DENSE_MIN_THREADS = 64
+DENSE_COLUMNS = 512
+# Above this share of changed threads an update recomputes every neighbour list.
+REBUILD_SHARE = 0.25
+ARRAYS = ('thread_ids', 'neighbours', 'scores', 'features', 'idf', 'data', 'indices', 'indptr')
+META_FILE = 'meta.json'
+
+
+def feature_pairs(session, thread_ids=None):
+    """(thread id, feature key) pairs of the given threads, or of every thread, as an (n, 2) array."""
+    pairs = list()
+    for kind_number, (kind, sql) in enumerate(FEATURE_SOURCES.items()):
+        chunks = [None] if thread_ids is None else list(chunked(thread_ids))
+        for chunk in chunks:
+            params = dict()
+            where = sql
+            if chunk is not None:
+                ids, params = in_list(chunk)
+                glue = " AND " if " WHERE " in sql else " WHERE "
+                where = f"{sql}{glue}{PAIR_FILTERS[kind]} IN ({ids})"
+            kind_pairs = int_rows(session, where, params)
+            kind_pairs[:, 1] |= kind_number << 32
+            pairs.append(kind_pairs)
+    return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+
+def _select(ids, scores, k):
+    """Best k (ids, scores) per row of candidate arrays, best first, ties by thread id; empty slots are -1/0."""
+    k = min(k, scores.shape[1])
+    neighbours = np.full((scores.shape[0], k), -1, dtype=np.int64)
+    best_scores = np.zeros((scores.shape[0], k), dtype=np.float32)
+    if k == 0:
+        return neighbours, best_scores
+    best = np.argpartition(scores, scores.shape[1] - k, axis=1)[:, -k:]
+    chosen_scores = np.take_along_axis(scores, best, axis=1)
+    chosen_ids = np.take_along_axis(np.broadcast_to(ids, scores.shape), best, axis=1)
+    order = np.lexsort((chosen_ids, -chosen_scores), axis=-1)
+    chosen_scores = np.take_along_axis(chosen_scores, order, axis=1)
+    chosen_ids = np.take_along_axis(chosen_ids, order, axis=1)
+    found = chosen_scores > 0
+    neighbours[found] = chosen_ids[found]
+    best_scores[found] = chosen_scores[found]
+    return neighbours, best_scores
+
+
+class SimilarityIndex:
+    """
+    "Threads like this one" from shared tags, developer and prefixes. Every thread is a TF-IDF row
+    of a sparse thread x feature matrix with unit length, so similarity is the cosine, and the
+    k best neighbours of every thread are precomputed with batched sparse products. A lookup is a
+    binary search over the sorted thread ids plus one row of the memory-mapped neighbour arrays.
+    """
+
+    def __init__(self, k=NEIGHBOURS):
+        self.k = k
+        self.thread_ids = np.zeros(0, dtype=np.int64)
+        self.neighbours = np.zeros((0, k), dtype=np.int64)
+        self.scores = np.zeros((0, k), dtype=np.float32)
+        self.features = np.zeros(0, dtype=np.int64)
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.updated = None
+        self._arrays = None
+        self._matrix = sp.csr_matrix((0, 0), dtype=np.float32)
+
+    @property
+    def matrix(self):
+        # A loaded index only builds the matrix when an update needs it.
+        if self._arrays is not None:
+            data, indices, indptr = self._arrays
+            self._matrix = sp.csr_matrix((np.asarray(data), np.asarray(indices), np.asarray(indptr)),
+                                         shape=(len(self.thread_ids), len(self.features)))
+            self._arrays = None
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self._arrays = None
+        self._matrix = matrix
+
+    def _rows(self, thread_ids, pairs):
+        """Unit length TF-IDF rows for the sorted thread_ids from their (thread id, feature key) pairs."""
+        rows = np.searchsorted(thread_ids, pairs[:, 0])
+        columns = np.searchsorted(self.features, pairs[:, 1])
+        weights = np.array([FEATURE_WEIGHTS[kind] for kind in KINDS], dtype=np.float32)
+        data = self.idf[columns] * weights[pairs[:, 1] >> 32]
+        matrix = sp.csr_matrix((data, (rows, columns)), shape=(len(thread_ids), len(self.features)),
+                               dtype=np.float32)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return (sp.diags(1 / norms).astype(np.float32) @ matrix).tocsr()
+
+    def _top_k(self, positions):
+        """Neighbour lists for the rows at positions, scored against every thread."""
+        matrix = self.matrix.tocsc()
+        shared = np.diff(matrix.indptr)
+        common = np.argsort(-shared, kind='stable')[:DENSE_COLUMNS]
+        common = np.sort(common[shared[common] >= DENSE_MIN_THREADS])
+        rare = np.setdiff1d(np.arange(matrix.shape[1]), common)
+        dense = matrix[:, common].toarray()
+        sparse = matrix[:, rare].tocsr()
+        transposed = sparse.T.tocsr()
+        neighbours = np.full((len(positions), self.k), -1, dtype=np.int64)
+        scores = np.zeros((len(positions), self.k), dtype=np.float32)
+        for start in range(0, len(positions), BATCH_ROWS):
+            batch = positions[start:start + BATCH_ROWS]
+            sims = dense[batch] @ dense.T
+            sims += (sparse[batch] @ transposed).toarray()
+            sims[np.arange(len(batch)), batch] = 0
+            found, found_scores = _select(self.thread_ids, sims, self.k)
+            neighbours[start:start + len(batch), :found.shape[1]] = found
+            scores[start:start + len(batch), :found.shape[1]] = found_scores
+        return neighbours, scores
+
+    @classmethod
+    def build(cls, session, k=NEIGHBOURS):
+        """Reads every thread's features and computes all neighbour lists."""
+        index = cls(k)
+        index.updated, = session.execute(text("SELECT max(updated) FROM thread")).fetchone()
+        index.thread_ids = int_rows(session, "SELECT id FROM thread ORDER BY id", columns=1)[:, 0]
+        pairs = feature_pairs(session)
+        pairs = pairs[np.isin(pairs[:, 0], index.thread_ids)]
+        index.features, df = np.unique(pairs[:, 1], return_counts=True)
+        # Smoothed IDF, so a feature every thread has still counts a little.
+        index.idf = (np.log((1 + len(index.thread_ids)) / (1 + df)) + 1).astype(np.float32)
+        index.matrix = index._rows(index.thread_ids, pairs)
+        index.neighbours, index.scores = index._top_k(np.arange(len(index.thread_ids)))
+        return index
+
+    def update(self, session, thread_ids=None):
+        """
+        Re-reads the given threads (by default those written since the index was built or last
+        updated), recomputes their neighbour lists and merges them into everyone else's. Threads no
+        longer in the database are dropped from the index and from every neighbour list. IDF weights
+        stay those of the last build; features first seen here weigh as if one thread had them.
+        Returns the number of threads re-read.
+        """
+        high_water, = session.execute(text("SELECT max(updated) FROM thread")).fetchone()
+        if thread_ids is None:
+            thread_ids = [thread_id for thread_id, in session.execute(
+                text("SELECT id FROM thread WHERE updated > :since"), {'since': self.updated or 0})]
+        existing = int_rows(session, "SELECT id FROM thread", columns=1)[:, 0]
+        # Deleted threads never show up as written since, so they are found by what the index still holds.
+        deleted = np.setdiff1d(self.thread_ids, existing)
+        thread_ids = np.union1d(np.array(list(thread_ids), dtype=np.int64), deleted)
+        self.updated = high_water
+        if not len(thread_ids):
+            return 0
+        present = np.intersect1d(thread_ids, existing)
+        pairs = feature_pairs(session, present.tolist())
+
+        new_features = np.setdiff1d(pairs[:, 1], self.features)
+        matrix = self.matrix
+        if len(new_features):
+            features = np.union1d(self.features, new_features)
+            matrix = sp.csr_matrix((matrix.data, np.searchsorted(features, self.features)[matrix.indices],
+                                    matrix.indptr), shape=(matrix.shape[0], len(features)))
+            idf = np.full(len(features), np.log((1 + len(self.thread_ids)) / 2) + 1, dtype=np.float32)
+            idf[np.searchsorted(features, self.features)] = self.idf
+            self.features, self.idf = features, idf
+
+        keep = ~np.isin(self.thread_ids, thread_ids)
+        ids = np.concatenate([self.thread_ids[keep], present])
+        order = np.argsort(ids, kind='stable')
+        self.matrix = sp.vstack([matrix[keep], self._rows(present, pairs)]).tocsr()[order]
+        pad = np.full((len(present), self.k), -1, dtype=np.int64)
+        self.neighbours = np.concatenate([self.neighbours[keep], pad])[order]
+        self.scores = np.concatenate([self.scores[keep], np.zeros(pad.shape, dtype=np.float32)])[order]
+        self.thread_ids = ids[order]
+        changed = np.searchsorted(self.thread_ids, present)
+
+        if len(present) > REBUILD_SHARE * len(self.thread_ids):
+            self.neighbours, self.scores = self._top_k(np.arange(len(self.thread_ids)))
+            return len(thread_ids)
+        # A list without re-read threads only has to take them in where they now score higher. A list
+        # that had one may need a thread it never kept, so it is recomputed along with the re-read ones.
+        stale = np.flatnonzero(np.isin(self.neighbours, thread_ids).any(axis=1))
+        transposed = self.matrix[changed].T.tocsr()
+        for start in range(0, len(self.thread_ids), BATCH_ROWS):
+            rows = slice(start, start + BATCH_ROWS)
+            sims = (self.matrix[rows] @ transposed).toarray()
+            candidates = np.concatenate([self.neighbours[rows], np.broadcast_to(present, sims.shape)], axis=1)
+            self.neighbours[rows], self.scores[rows] = _select(
+                candidates, np.concatenate([self.scores[rows], sims], axis=1), self.k)
+        recompute = np.union1d(changed, stale)
+        self.neighbours[recompute], self.scores[recompute] = self._top_k(recompute)
+        return len(thread_ids)
+
+    def similar(self, thread_id, limit=None):
+        """The neighbours of a thread as [(thread_id, cosine similarity)], most similar first."""
+        position = np.searchsorted(self.thread_ids, thread_id)
+        if position == len(self.thread_ids) or self.thread_ids[position] != thread_id:
+            raise KeyError(thread_id)
+        neighbours = self.neighbours[position, :limit]
+        scores = self.scores[position, :limit]
+        return [(int(neighbour), float(score)) for neighbour, score in zip(neighbours, scores) if neighbour >= 0]
+
+    def save(self, path):
+        """Writes the index as one .npy file per array in the directory path, replacing each atomically."""
+        os.makedirs(path, exist_ok=True)
+        matrix = self.matrix
+        arrays = {'thread_ids': self.thread_ids, 'neighbours': self.neighbours, 'scores': self.scores,
+                  'features': self.features, 'idf': self.idf, 'data': matrix.data,
+                  'indices': matrix.indices, 'indptr': matrix.indptr}
+        for name, array in arrays.items():
+            temporary = os.path.join(path, f'{name}.tmp.npy')
+            np.save(temporary, np.ascontiguousarray(array))
+            os.replace(temporary, os.path.join(path, f'{name}.npy'))
+        with open(os.path.join(path, META_FILE), 'w') as metafile:
+            json.dump({'k': self.k, 'updated': self.updated, 'weights': FEATURE_WEIGHTS, 'saved': time.time()},
+                      metafile, indent=1)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Opens a saved index with its arrays memory-mapped. Load with mmap False before an update, a
+        mapped file cannot be replaced on Windows.
+        """
+        with open(os.path.join(path, META_FILE), 'r') as metafile:
+            meta = json.load(metafile)
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+                  for name in ARRAYS}
+        index = cls(meta['k'])
+        index.updated = meta['updated']
+        index.thread_ids = arrays['thread_ids']
+        index.neighbours = arrays['neighbours']
+        index.scores = arrays['scores']
+        index.features = arrays['features']
+        index.idf = arrays['idf']
+        index._arrays = arrays['data'], arrays['indices'], arrays['indptr']
+        return index
+
+
+def update_similarity_index(path, session, thread_ids=None):
+    """Applies freshly ingested threads to a saved index, building it from scratch if it does not exist."""
+    try:
+        index = SimilarityIndex.load(path, mmap=False)
+    except FileNotFoundError:
+        index = SimilarityIndex.build(session)
+    else:
+        index.update(session, thread_ids)
+    index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Threads similar to a thread by tags, developer and prefixes.")
+    parser.add_argument('thread', type=int, nargs='?', help="thread id to find neighbours for")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--index', default='similarity', help="directory of the saved index")
+    parser.add_argument('--build', action='store_true', help="rebuild the index from the database")
+    parser.add_argument('--refresh', action='store_true', help="apply the threads written since the last save")
+    parser.add_argument('--neighbours', type=int, default=NEIGHBOURS, help="neighbours kept per thread on build")
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+    session = sessionmaker(bind=db_connect(args.db, 'query'))()
+    started = time.perf_counter()
+    if args.build or not os.path.exists(os.path.join(args.index, META_FILE)):
+        similarity_index = SimilarityIndex.build(session, args.neighbours)
+        similarity_index.save(args.index)
+        print(f"{len(similarity_index.thread_ids)} threads indexed in {time.perf_counter() - started:.1f}s")
+    elif args.refresh:
+        similarity_index = SimilarityIndex.load(args.index, mmap=False)
+        count = similarity_index.update(session)
+        similarity_index.save(args.index)
+        print(f"{count} threads refreshed in {time.perf_counter() - started:.1f}s")
+    if args.thread is not None:
+        similarity_index = SimilarityIndex.load(args.index)
+        started = time.perf_counter()
+        neighbours = similarity_index.similar(args.thread, args.limit)
+        elapsed = time.perf_counter() - started
+        titles = dict(session.execute(text("SELECT id, title FROM thread WHERE id IN ({})".format(
+            ', '.join(str(thread_id) for thread_id, score in neighbours) or 'NULL'))).fetchall())
+        for thread_id, score in neighbours:
+            print(f"{thread_id:>8} {score:6.3f}  {titles.get(thread_id)}")
+        print(f"lookup {elapsed * 1000:.3f} ms")
+    session.close()
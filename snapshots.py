@@ -0,0 +1,137 @@
+import time
+import argparse
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+from f95_models import db_connect, chunked, in_list, int_rows, DEFAULT_DB_PATH, Snapshot
+
+
+SNAPSHOT_COLUMNS = ['views', 'likes', 'votes', 'rating', 'version', 'edited']
+# Metrics the trend queries can rank by.
+METRICS = ('views', 'likes', 'votes', 'rating')
+DAY = 86400
+
+LATEST_ROWS = '''
+    SELECT snapshot.thread_id, snapshot.views, snapshot.likes, snapshot.votes, snapshot.rating, snapshot.version,
+           snapshot.edited
+    FROM snapshot WHERE snapshot.thread_id IN ({ids})
+    AND snapshot.taken = (SELECT max(taken) FROM snapshot AS latest WHERE latest.thread_id = snapshot.thread_id)
+'''
+GROWTH_ROWS = '''
+    SELECT id, coalesce(begin, first, 0), coalesce(end, 0) FROM (
+        SELECT thread.id AS id,
+            (SELECT {metric} FROM snapshot WHERE thread_id = thread.id AND taken <= :start
+             ORDER BY taken DESC LIMIT 1) AS begin,
+            (SELECT {metric} FROM snapshot WHERE thread_id = thread.id AND taken > :start AND taken <= :now
+             ORDER BY taken LIMIT 1) AS first,
+            (SELECT {metric} FROM snapshot WHERE thread_id = thread.id AND taken <= :now
+             ORDER BY taken DESC LIMIT 1) AS end
+        FROM thread)
+    WHERE end IS NOT NULL
+'''
+
+
+def pack_rating(rating):
+    return None if rating is None else int(round(rating * 100))
+
+
+def snapshot_row(threadrow):
+    """The snapshot columns of a Thread row dict, with the rating packed."""
+    row = {column: threadrow.get(column) for column in SNAPSHOT_COLUMNS}
+    row['rating'] = pack_rating(row['rating'])
+    return row
+
+
+def record_snapshots(session, threadrows, taken=None):
+    """
+    Appends a snapshot taken at unix time taken for every thread row (dicts with id plus the Thread
+    metric columns) whose metrics differ from its latest snapshot. Returns the number written.
+    """
+    taken = int(time.time()) if taken is None else taken
+    rows = {threadrow['id']: snapshot_row(threadrow) for threadrow in threadrows}
+    for chunk in chunked(rows):
+        ids, params = in_list(chunk)
+        for thread_id, *latest in session.execute(text(LATEST_ROWS.format(ids=ids)), params):
+            if rows[thread_id] == dict(zip(SNAPSHOT_COLUMNS, latest)):
+                del rows[thread_id]
+    changed = [dict(row, thread_id=thread_id, taken=taken) for thread_id, row in rows.items()]
+    if changed:
+        # A thread refreshed twice in one run keeps the last values of that run.
+        session.execute(Snapshot.__table__.insert().prefix_with('OR REPLACE'), changed)
+    return len(changed)
+
+
+def record_listing_snapshots(session, listing, thread_ids, taken=None):
+    """
+    Snapshots for threads whose page was not written this run (unchanged, not modified), whose views,
+    likes, rating and version still move with every listing refresh. The listing values are laid over
+    the stored thread row; threads missing from the listing or the database are left out.
+    Returns the number written.
+    """
+    threadrows = list()
+    for chunk in chunked(thread_id for thread_id in thread_ids if thread_id in listing):
+        ids, params = in_list(chunk)
+        rows = session.execute(text(f"SELECT id, {', '.join(SNAPSHOT_COLUMNS)} FROM thread WHERE id IN ({ids})"),
+                               params)
+        for row in rows:
+            threadrow = dict(zip(['id'] + SNAPSHOT_COLUMNS, row))
+            listed = listing[threadrow['id']]
+            threadrow.update(views=listed.views, likes=listed.likes, rating=listed.rating, version=listed.version)
+            threadrows.append(threadrow)
+    return record_snapshots(session, threadrows, taken)
+
+
+def history(session, thread_id):
+    """All snapshots of one thread, oldest first, as (taken, views, likes, votes, rating, version, edited)."""
+    rows = session.execute(text(
+        "SELECT taken, views, likes, votes, rating, version, edited FROM snapshot WHERE thread_id = :thread_id "
+        "ORDER BY taken"), {'thread_id': thread_id}).fetchall()
+    return [(taken, views, likes, votes, None if rating is None else rating / 100, version, edited)
+            for taken, views, likes, votes, rating, version, edited in rows]
+
+
+def growth(session, metric='views', days=30, now=None):
+    """
+    Change of metric per thread over the last days, as NumPy arrays (thread_ids, start, end). The
+    starting value is the last snapshot before the window, or the first one inside it for threads
+    first seen during the window. Each value is one primary key seek per thread, so the cost does
+    not depend on how many snapshots the window holds.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+    now = int(time.time()) if now is None else now
+    values = int_rows(session, GROWTH_ROWS.format(metric=metric), {'start': now - days * DAY, 'now': now}, 3)
+    return values[:, 0], values[:, 1], values[:, 2]
+
+
+def top_growth(session, metric='views', days=30, limit=20, now=None):
+    """The limit threads whose metric grew the most over the last days, as (thread_id, start, end, growth)."""
+    thread_ids, begin, end = growth(session, metric, days, now)
+    change = end - begin
+    limit = min(limit, len(change))
+    best = np.argpartition(-change, limit - 1)[:limit] if limit else np.zeros(0, dtype=np.int64)
+    best = best[np.argsort(-change[best], kind='stable')]
+    if metric == 'rating':
+        return [(int(thread_ids[i]), begin[i] / 100, end[i] / 100, change[i] / 100) for i in best]
+    return [(int(thread_ids[i]), int(begin[i]), int(end[i]), int(change[i])) for i in best]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Trends over the per-run thread metric snapshots.")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH)
+    parser.add_argument('--metric', choices=METRICS, default='views')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--thread', type=int, help="print the snapshot history of one thread instead")
+    args = parser.parse_args()
+    session = sessionmaker(bind=db_connect(args.db, 'query'))()
+    if args.thread is not None:
+        for snapshot in history(session, args.thread):
+            print(time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot[0])), *snapshot[1:])
+    else:
+        started = time.perf_counter()
+        top = top_growth(session, args.metric, args.days, args.limit)
+        for thread_id, begin, end, change in top:
+            print(f"{thread_id:>8} {begin:>12} -> {end:>12}  {change:+}")
+        print(f"{time.perf_counter() - started:.3f}s")
+    session.close()